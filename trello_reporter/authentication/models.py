@@ -1,10 +1,17 @@
 from __future__ import unicode_literals
 
+import copy
+import threading
+import time
+
 import pytz
 
+from django.conf import settings
 from django.contrib.postgres.fields.jsonb import JSONField
 from django.core.exceptions import ObjectDoesNotExist
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch.dispatcher import receiver
 
 from trello_reporter.charting.constants import INITIAL_COLUMNS, SPRINT_COMMITMENT_COLUMNS
 
@@ -67,31 +74,79 @@ class KeyValQuerySet(models.QuerySet):
         return self.filter(key=key)
 
     def for_user(self, user_id):
-        return self.filter(value__user_id=user_id)
+        return self.filter(user_id=user_id)
 
     def for_board(self, board_id):
-        return self.filter(value__board_id=board_id)
+        return self.filter(board_id=board_id)
+
+    def not_backfilled(self):
+        """ settings stored before user_id and board_id columns existed """
+        return self.filter(user_id__isnull=True, board_id__isnull=True)
 
     def get_or_create_setting(self, key, user_id=None, board_id=None, default=None):
-        q = {"key": key}
+        q = self.for_key(key)
+        legacy_q = self.for_key(key).not_backfilled()
         if user_id:
-            q["value__user_id"] = user_id
+            q = q.for_user(user_id)
+            legacy_q = legacy_q.filter(value__user_id=user_id)
         if board_id:
-            q["value__board_id"] = board_id
+            q = q.for_board(board_id)
+            legacy_q = legacy_q.filter(value__board_id=board_id)
         try:
-            return self.get(**q)
+            return q.get()
+        except ObjectDoesNotExist:
+            pass
+        try:
+            kv = legacy_q.get()
         except ObjectDoesNotExist:
             value = {}
-            if board_id:
+            if user_id:
                 value["user_id"] = user_id
             if board_id:
                 value["board_id"] = board_id
             if default:
                 value.update(default)
             return self.create(key=key, value=value)
+        # fill the columns, next time the setting is found using them
+        kv.save()
+        return kv
 
 
 class KeyValManager(models.Manager):
+    # (key, user_id, board_id) -> (time of caching, KeyVal)
+    _cache = {}
+    _cache_lock = threading.Lock()
+    # incremented on every change of settings
+    _cache_generation = 0
+
+    def get_or_create_setting(self, key, user_id=None, board_id=None, default=None):
+        """
+        KeyValQuerySet.get_or_create_setting cached in memory of the process; settings are
+        cached for settings.KEYVAL_CACHE_TTL seconds since other processes can change them
+
+        :return: a copy of KeyVal, it can be changed and saved
+        """
+        cache_key = (key, user_id, board_id)
+        now = time.time()
+        with self._cache_lock:
+            cached = self._cache.get(cache_key, None)
+            generation = KeyValManager._cache_generation
+        if cached is None or now - cached[0] > settings.KEYVAL_CACHE_TTL:
+            kv = self.get_queryset().get_or_create_setting(
+                key, user_id=user_id, board_id=board_id, default=default)
+            cached = (now, kv)
+            with self._cache_lock:
+                # don't cache a setting which was changed meanwhile
+                if generation == KeyValManager._cache_generation:
+                    self._cache[cache_key] = cached
+        return cached[1].copy()
+
+    @classmethod
+    def invalidate_cache(cls):
+        with cls._cache_lock:
+            KeyValManager._cache_generation += 1
+            cls._cache.clear()
+
     def displayed_cols_in_board_detail(self, user, board):
         return self.get_or_create_setting(
             KeyVal.DISPLAYED_COLS_IN_BOARD_DETAIL, user_id=user.id, board_id=board.id,
@@ -124,12 +179,34 @@ class KeyVal(models.Model):
     """ key & value table """
     key = models.CharField(max_length=63, db_index=True)
     value = JSONField()
+    # copied from value, so settings can be looked up using an index
+    user_id = models.IntegerField(blank=True, null=True)
+    board_id = models.IntegerField(blank=True, null=True)
 
     objects = KeyValManager.from_queryset(KeyValQuerySet)()
 
+    class Meta:
+        index_together = ("key", "board_id", "user_id")
+
     def __unicode__(self):
         return "%s: %s" % (self.key, self.value)
 
+    def save(self, *args, **kwargs):
+        self.user_id = self.value.get("user_id", None)
+        self.board_id = self.value.get("board_id", None)
+        super(KeyVal, self).save(*args, **kwargs)
+
+    def copy(self):
+        """ :return: KeyVal, the same setting, changes of its value don't affect self """
+        return KeyVal(id=self.id, key=self.key, value=copy.deepcopy(self.value),
+                      user_id=self.user_id, board_id=self.board_id)
+
     DISPLAYED_COLS_IN_BOARD_DETAIL = "DISPLAYED_COLS_IN_BOARD_DETAIL"
     SPRINT_COMMITMENT_COLS = "SPRINT_COMMITMENT_COLS"
     BOARD_MESSAGES = "BOARD_MESSAGES"
+
+
+@receiver(post_save, sender=KeyVal)
+@receiver(post_delete, sender=KeyVal)
+def invalidate_keyval_cache_cb(*args, **kwargs):
+    KeyValManager.invalidate_cache()
@@ -0,0 +1,153 @@
+"""
+Cache of computed chart data
+
+Charts are computed from data of a board which change only when new card actions are loaded
+or sprints are changed; every such change bumps Board.data_version. The version is part of the
+cache key, so entries of older data are never served, they just get evicted.
+"""
+
+from __future__ import unicode_literals
+
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUBackend(object):
+    """ in memory of the process, the least recently used entries are evicted """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: int, max number of entries, 0 disables caching
+        """
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """ :return: tuple, (found, value) """
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return False, None
+            self.entries[key] = value  # move to the end
+            return True, value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DjangoCacheBackend(object):
+    """ django cache (settings.CACHES["default"]), can be shared by processes """
+
+    def __init__(self, max_size):
+        """
+        :param max_size: int, ignored, configure MAX_ENTRIES of the django cache instead
+        """
+        self.cache = caches["default"]
+
+    def get(self, key):
+        """ :return: tuple, (found, value) """
+        wrapped = self.cache.get(key, None)
+        if wrapped is None:
+            return False, None
+        return True, wrapped[0]
+
+    def set(self, key, value):
+        # wrapped, so None can be cached as well
+        self.cache.set(key, (value, ))
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class ChartCache(object):
+    def __init__(self, backend=None):
+        """
+        :param backend: instance of a backend, defaults to settings.CHART_CACHE_BACKEND of
+                        size settings.CHART_CACHE_SIZE
+        """
+        self._backend = backend
+        self.lock = threading.Lock()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+        }
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            backend_class = import_string(settings.CHART_CACHE_BACKEND)
+            self._backend = backend_class(settings.CHART_CACHE_SIZE)
+        return self._backend
+
+    @staticmethod
+    def get_key(board, chart_name, params):
+        """
+        :param board: Board
+        :param chart_name: str
+        :param params: json-like structure, all the parameters the chart is computed from;
+                       dates are converted to strings
+        :return: str
+        """
+        params_json = json.dumps(params, sort_keys=True, default=unicode)
+        digest = hashlib.sha1(params_json.encode("utf-8")).hexdigest()
+        return "chart:%s:%s:%s:%s" % (chart_name, board.id, board.data_version, digest)
+
+    def get_or_compute(self, board, chart_name, params, compute):
+        """
+        return cached chart data, compute and store them if they are not cached
+
+        :param compute: callable without arguments which returns chart data
+        """
+        key = self.get_key(board, chart_name, params)
+        found, value = self.backend.get(key)
+        with self.lock:
+            self.counters["hits" if found else "misses"] += 1
+        if found:
+            logger.debug("chart data cached: %s", key)
+            return value
+        value = compute()
+        self.backend.set(key, value)
+        return value
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def clear(self):
+        self.backend.clear()
+        with self.lock:
+            self.counters = dict.fromkeys(self.counters, 0)
+
+
+# shared by all views in the process
+chart_cache = ChartCache()
@@ -0,0 +1,402 @@
+# -*- coding: utf-8 -*-
+"""
+Load card actions fetched from trello into database
+
+Processing an action depends on the latest action of its card and on the latest running totals
+of lists; this state is kept in memory for the whole sync, so the database is read only once per
+chunk of actions, for cards and lists seen for the first time. Rows are written with bulk_create,
+one transaction per chunk.
+
+Actions which are already stored are skipped: trello's `since` is inclusive and a failed sync
+can be simply run again.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+
+from django.db import transaction, IntegrityError
+from django.utils.dateparse import parse_datetime
+
+from trello_reporter.charting.constants import MAX_STORY_POINTS
+from trello_reporter.charting.models import Card, CardAction, List, ListStat, BoardList, \
+    CardState
+from trello_reporter.harvesting.models import CardActionEvent
+
+
+logger = logging.getLogger(__name__)
+
+
+# number of actions processed (and written) within a single transaction
+CHUNK_SIZE = 5000
+
+# number of rows in a single INSERT statement
+BULK_CREATE_BATCH_SIZE = 1000
+
+CREATE_LIKE_ACTIONS = ["createCard", "moveCardToBoard", "defaultCard",
+                       "copyCard", "convertToCardFromCheckItem"]
+UPDATE_ACTIONS = ["updateCard"]  # update = change list, board, close or open
+DELETE_LIKE_ACTIONS = ["moveCardFromBoard", "deleteCard"]
+
+
+def set_fk_ids(obj, *fields):
+    """
+    objects were linked together before they had primary keys; copy the keys now
+
+    :param obj: model instance
+    :param fields: names of foreign keys
+    """
+    for field in fields:
+        related = getattr(obj, field)
+        setattr(obj, field + "_id", related.pk if related is not None else None)
+
+
+class ListStatAccumulator(object):
+    """
+    running totals of lists during a sync
+
+    the latest totals are loaded once per list, new stats are kept in memory until flushed
+    """
+
+    def __init__(self):
+        # List.id -> (cards_rt, story_points_rt) of the latest stat, None = list has no stats
+        self.totals = {}
+        self.pending = []
+
+    def load(self, lists):
+        """ fetch latest totals of lists we don't know yet, in a single query """
+        list_ids = set(li.id for li in lists if li.id not in self.totals)
+        if not list_ids:
+            return
+        for list_id in list_ids:
+            self.totals[list_id] = None
+        for stat in ListStat.objects.latest_for_lists(list_ids):
+            self.totals[stat.list_id] = (stat.cards_rt, stat.story_points_rt)
+
+    def add_list(self, li):
+        """ list was just created, it can't have any stats """
+        self.totals[li.id] = None
+
+    def get(self, li):
+        """
+        :return: tuple, (cards_rt, story_points_rt)
+        """
+        if li.id not in self.totals:
+            logger.debug("totals of list %s were not preloaded", li)
+            self.load([li])
+        return self.totals[li.id] or (0, 0)
+
+    def add(self, ca, li, diff, cards_rt, sp_rt):
+        self.pending.append(ListStat(card_action=ca, list=li, diff=diff,
+                                     cards_rt=cards_rt, story_points_rt=sp_rt))
+        self.totals[li.id] = (cards_rt, sp_rt)
+
+    def flush(self):
+        for stat in self.pending:
+            set_fk_ids(stat, "card_action")
+        ListStat.objects.bulk_create(self.pending, batch_size=BULK_CREATE_BATCH_SIZE)
+        self.pending = []
+
+
+class Ingestor(object):
+    """
+    process card actions of a single board, oldest first
+    """
+
+    def __init__(self, board, chunk_size=CHUNK_SIZE, progress=None):
+        """
+        :param progress: callable, called with number of processed actions after every chunk
+        """
+        self.board = board
+        self.chunk_size = chunk_size
+        self.progress = progress
+        # number of actions stored, the ones which were stored already are not counted
+        self.stored = 0
+        self._reset()
+
+    def _reset(self):
+        """ forget everything loaded from database """
+        # trello card id -> Card
+        self.cards = {}
+        # trello card id -> latest CardAction of the card (None = card has no actions)
+        self.latest_actions = {}
+        # trello list id -> List
+        self.lists = {}
+        self.stats = ListStatAccumulator()
+
+        # pending writes of the current chunk
+        self._new_cards = []
+        # trello card id -> Card; new cards don't have a primary key, hence they can't be hashed
+        self._renamed_cards = {}
+        self._renamed_lists = set()
+        self._events = []
+        self._card_actions = []
+        # List -> date of the latest card action on the list
+        self._seen_lists = {}
+
+    def ingest(self, actions):
+        """
+        process and store actions
+
+        :param actions: iterable of json-like structures, oldest first
+        :return: int, number of processed actions
+        """
+        # registry and state need to be complete before they're updated
+        BoardList.objects.ensure_for_board(self.board)
+        CardState.objects.ensure_for_board(self.board)
+        count = 0
+        chunk = []
+        for action_data in actions:
+            chunk.append(action_data)
+            if len(chunk) >= self.chunk_size:
+                self._ingest_chunk(chunk)
+                count += len(chunk)
+                chunk = []
+                if self.progress is not None:
+                    self.progress(count)
+        if chunk:
+            self._ingest_chunk(chunk)
+            count += len(chunk)
+        if self.progress is not None:
+            self.progress(count)
+        return count
+
+    def _ingest_chunk(self, actions, retry=True):
+        actions = self._drop_stored(actions)
+        if not actions:
+            return
+        logger.debug("processing chunk of %d actions", len(actions))
+        trello_card_ids = set(a["data"]["card"]["id"] for a in actions)
+        self._load_cards(trello_card_ids)
+        trello_list_ids = self._load_lists(actions)
+
+        touched_lists = [self.lists[x] for x in trello_list_ids if x in self.lists]
+        for trello_card_id in trello_card_ids:
+            previous_action = self.latest_actions.get(trello_card_id, None)
+            if previous_action and previous_action.list:
+                touched_lists.append(previous_action.list)
+        self.stats.load(touched_lists)
+
+        try:
+            with transaction.atomic():
+                for action_data in actions:
+                    self._process(action_data)
+                self._flush()
+        except IntegrityError:
+            if not retry:
+                raise
+            # the board is being synced concurrently and some of the actions were stored
+            # meanwhile: start over with fresh state from database
+            logger.warning("actions were stored concurrently, processing the chunk again")
+            self._reset()
+            self._ingest_chunk(actions, retry=False)
+        else:
+            self.stored += len(actions)
+
+    def _drop_stored(self, actions):
+        """
+        skip actions which are stored already and duplicates within actions
+
+        :return: list of actions to process
+        """
+        trello_ids = set(a["id"] for a in actions if a.get("id", None))
+        stored = set(CardActionEvent.objects.filter(trello_id__in=trello_ids)
+                     .values_list("trello_id", flat=True))
+        # events stored before they had trello_id
+        stored.update(CardAction.objects.filter(trello_id__in=trello_ids)
+                      .values_list("trello_id", flat=True))
+        response = []
+        for action_data in actions:
+            trello_id = action_data.get("id", None)
+            if trello_id:
+                if trello_id in stored:
+                    continue
+                stored.add(trello_id)
+            response.append(action_data)
+        if len(response) < len(actions):
+            logger.info("%d actions are stored already", len(actions) - len(response))
+        return response
+
+    def _load_cards(self, trello_card_ids):
+        """ fetch cards and their latest actions which we haven't seen yet """
+        missing = [x for x in trello_card_ids if x not in self.cards]
+        if not missing:
+            return
+        # trello_id is not unique, stick to the oldest card
+        for card in Card.objects.filter(trello_id__in=missing).order_by("-id"):
+            self.cards[card.trello_id] = card
+        existing_ids = [self.cards[x].id for x in missing if x in self.cards]
+        for ca in CardAction.objects.for_cards(existing_ids).distinct_cards() \
+                .select_related("list", "card"):
+            self.latest_actions[ca.card.trello_id] = ca
+        for trello_card_id in missing:
+            if trello_card_id not in self.cards:
+                card = Card(trello_id=trello_card_id)
+                self.cards[trello_card_id] = card
+                self._new_cards.append(card)
+
+    def _load_lists(self, actions):
+        """
+        fetch lists which we haven't seen yet
+
+        :return: set of trello list ids present in actions
+        """
+        trello_list_ids = set()
+        for action_data in actions:
+            for key in ("list", "listAfter"):
+                trello_list_id = action_data["data"].get(key, {}).get("id", None)
+                if trello_list_id:
+                    trello_list_ids.add(trello_list_id)
+        missing = [x for x in trello_list_ids if x not in self.lists]
+        for li in List.objects.filter(trello_id__in=missing):
+            self.lists[li.trello_id] = li
+        return trello_list_ids
+
+    def get_list(self, trello_list_id, list_name):
+        """ the same as List.get_or_create_list, lists are created right away """
+        try:
+            li = self.lists[trello_list_id]
+        except KeyError:
+            li = List.objects.create(trello_id=trello_list_id, name=list_name)
+            self.lists[trello_list_id] = li
+            self.stats.add_list(li)
+        if list_name is not None and li.name != list_name:
+            # set or update the list name
+            li.name = list_name
+            self._renamed_lists.add(li)
+        return li
+
+    def _process(self, action_data):
+        board = self.board
+        card = self.cards[action_data["data"]["card"]["id"]]
+
+        event = CardActionEvent(data=action_data, trello_id=action_data.get("id", None))
+        self._events.append(event)
+        ca = CardAction(
+            trello_id=action_data.get("id", None),
+            date=parse_datetime(action_data["date"]),
+            action_type=action_data["type"],
+            card=card,
+            event=event,
+            board=board,  # TODO: use board from action_data
+            **CardAction.fields_from_event(event.view)
+        )
+
+        if ca.card_name and card.name != ca.card_name:
+            card.name = ca.card_name[:255]  # some users are just fun
+            self._renamed_cards[card.trello_id] = card
+
+        previous_action = self.latest_actions.get(card.trello_id, None)
+        story_points_str = CardAction.get_story_points(ca.card_name)
+        story_points_int = 0
+        if story_points_str is not None:
+            story_points_int = int(story_points_str)
+            ca.story_points = story_points_int if story_points_int <= MAX_STORY_POINTS \
+                else MAX_STORY_POINTS
+
+        # figure out list_name, archivals, removals and unicorns
+        if ca.action_type in CREATE_LIKE_ACTIONS:
+            if ca.trello_board_id != board.trello_id:
+                logger.info("card %s was created on board %s",
+                            ca.trello_card_id, ca.trello_board_id)
+                # we don't care about such state
+                return
+            # when list is changed (or on different board), name is missing; fun stuff!
+            trello_list_id, list_name = ca.list_id_and_name
+            if not trello_list_id:
+                logger.warning("list not specified for card '%s'", card.name)
+                # wat?! how about telling us to which list this is going
+                return
+            ca.list = self.get_list(trello_list_id, list_name)
+
+        elif ca.action_type in UPDATE_ACTIONS:
+            if ca.archiving:
+                ca.list = None
+                ca.is_archived = True
+            elif ca.opening or ca.rename:
+                # card is opened again
+                trello_list_id, list_name = ca.list_id_and_name
+                if not trello_list_id:
+                    logger.warning("card updated to unknown list: %s", ca)
+                    # cards without lists are useless to us; srsly trello?!
+                    return
+                ca.list = self.get_list(trello_list_id, list_name)
+                if previous_action:
+                    if previous_action.list != ca.list:
+                        logger.info("sneaky list change %s: %s -> %s",
+                                    card, previous_action.list, ca.list)
+                    elif ca.story_points == previous_action.story_points:
+                        # just name update, we don't care about that
+                        return
+            else:
+                if previous_action and previous_action.is_archived:
+                    logger.info("archived card %s is being moved", card)
+                    return
+                trello_list_id, list_name = ca.target_list_id_and_name
+                ca.list = self.get_list(trello_list_id, list_name)
+
+        elif ca.action_type in DELETE_LIKE_ACTIONS:
+            if previous_action:
+                ca.list = None
+                ca.is_deleted = True
+            else:
+                logger.info("card %s (%s) has unknown previous state",
+                            ca.trello_card_id, ca.card_name)
+                # default card?
+                return
+
+        event.processed_well = True
+        self._card_actions.append(ca)
+        self.latest_actions[card.trello_id] = ca
+        if ca.list:
+            self._seen_lists[ca.list] = max(ca.date, self._seen_lists.get(ca.list, ca.date))
+
+        # ListStats
+        if ca.rename and previous_action and previous_action.list == ca.list:
+            cards_rt, sp_rt = self.stats.get(ca.list)
+            previous_points = getattr(previous_action, "story_points", 0)
+            self.stats.add(ca, ca.list, 0, cards_rt,
+                           sp_rt - previous_points + story_points_int)
+        else:
+            if previous_action:
+                previous_list = previous_action.list
+                if previous_list:
+                    if previous_list == ca.list:
+                        # HACK: likely trello trashed an event of moving the card
+                        logger.warning("card %s is already on list %s", card, previous_list)
+                    cards_rt, sp_rt = self.stats.get(previous_list)
+                    self.stats.add(ca, previous_list, -1, cards_rt - 1,
+                                   sp_rt - previous_action.story_points)
+            if ca.list and not (ca.is_archived or ca.is_deleted):
+                cards_rt, sp_rt = self.stats.get(ca.list)
+                self.stats.add(ca, ca.list, 1, cards_rt + 1, sp_rt + story_points_int)
+
+    def _flush(self):
+        """ write everything processed in current chunk """
+        logger.debug("writing %d cards, %d events, %d card actions, %d stats",
+                     len(self._new_cards), len(self._events), len(self._card_actions),
+                     len(self.stats.pending))
+        Card.objects.bulk_create(self._new_cards, batch_size=BULK_CREATE_BATCH_SIZE)
+        new_card_ids = set(card.trello_id for card in self._new_cards)
+        for trello_card_id, card in self._renamed_cards.items():
+            if trello_card_id not in new_card_ids:
+                Card.objects.filter(id=card.id).update(name=card.name)
+        for li in self._renamed_lists:
+            li.save(update_fields=["name"])
+            BoardList.objects.filter(list=li).update(name=li.name)
+        BoardList.objects.update_for_board(self.board, self._seen_lists)
+
+        CardActionEvent.objects.bulk_create(self._events, batch_size=BULK_CREATE_BATCH_SIZE)
+        for ca in self._card_actions:
+            set_fk_ids(ca, "card", "event", "list")
+        CardAction.objects.bulk_create(self._card_actions, batch_size=BULK_CREATE_BATCH_SIZE)
+        self.stats.flush()
+        changed = set(ca.card.trello_id for ca in self._card_actions)
+        CardState.objects.update_for_board(self.board, [self.latest_actions[x] for x in changed])
+
+        self._new_cards = []
+        self._renamed_cards = {}
+        self._renamed_lists = set()
+        self._events = []
+        self._card_actions = []
+        self._seen_lists = {}
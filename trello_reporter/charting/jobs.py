@@ -0,0 +1,200 @@
+"""
+Synchronization of boards with trello in background
+
+Syncing a big board takes minutes, way too long for an HTTP request. Jobs are queued in
+database (SyncJob) and processed by a pool of threads: no other service is needed.
+
+A job can only be processed by the process which queued it: user's token is needed to talk to
+trello and we DO NOT store it persistently, ever, so it's kept in memory of the process. If
+the process dies, its jobs are considered abandoned after settings.SYNC_JOB_TIMEOUT seconds.
+"""
+
+from __future__ import unicode_literals
+
+import datetime
+import itertools
+import logging
+import os
+import re
+import threading
+
+import requests
+
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from django.utils.encoding import force_text
+from django.utils import timezone
+
+from trello_reporter.charting.models import Board, SyncJob
+
+
+logger = logging.getLogger(__name__)
+
+
+# query strings of URLs carry API key and token of the user
+URL_QUERY_RE = re.compile(r"(https?://[^\s?'\"]+)\?[^\s'\"]*")
+CREDENTIALS_RE = re.compile(r"\b(key|token)=[^&\s'\"]+")
+
+
+def error_message(ex):
+    """
+    message of an exception which can be stored and displayed to anyone
+
+    :return: str, without credentials
+    """
+    response = getattr(ex, "response", None)
+    if isinstance(ex, requests.RequestException) and response is not None:
+        return "%s: %s %s" % (ex.__class__.__name__, response.status_code, response.reason)
+    message = "%s: %s" % (ex.__class__.__name__, force_text(ex, errors="replace"))
+    message = URL_QUERY_RE.sub(r"\1", message)
+    return CREDENTIALS_RE.sub(r"\1=...", message)
+
+
+class SyncQueue(object):
+    def __init__(self, workers=None):
+        """
+        :param workers: int, number of threads processing jobs, defaults to settings.SYNC_WORKERS
+        """
+        self.workers_count = workers
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        # id of job queued by this process -> token of the user
+        self.tokens = {}
+        self.workers = []
+        self._worker_ids = itertools.count()
+        self._pid = None
+
+    def enqueue(self, board, user, token):
+        """
+        queue synchronization of the board; if the board is being synced already, the job in
+        progress is returned instead of a new one
+
+        :return: SyncJob
+        """
+        with transaction.atomic():
+            # jobs of a board are queued one at a time
+            Board.objects.select_for_update().filter(id=board.id).get()
+            job = SyncJob.objects.for_board(board).active().order_by("-id").first()
+            if job is not None:
+                if not self.is_abandoned(job):
+                    logger.info("board %s is being synced already: %s", board, job)
+                    return job
+                logger.warning("job %s was abandoned", job)
+                job.finish(SyncJob.FAILED, error="The job was abandoned, please try again.")
+            job = SyncJob.objects.create(board=board, user=user)
+        logger.info("queued %s", job)
+        with self.lock:
+            self._ensure_workers()
+            self.tokens[job.id] = token
+            self.wakeup.notify()
+        return job
+
+    def is_abandoned(self, job):
+        """ queued by a different process which didn't process it """
+        with self.lock:
+            if job.id in self.tokens:
+                return False
+        timeout = datetime.timedelta(seconds=settings.SYNC_JOB_TIMEOUT)
+        return job.updated < timezone.now() - timeout
+
+    def _ensure_workers(self):
+        """ start workers, if they are not running; lock has to be held """
+        if self._pid != os.getpid():
+            # threads don't survive fork, jobs of the parent are not ours
+            self.workers = []
+            self.tokens = {}
+            self._pid = os.getpid()
+        alive = [t for t in self.workers if t.is_alive()]
+        if len(alive) < len(self.workers):
+            logger.error("%d sync workers died, starting new ones",
+                         len(self.workers) - len(alive))
+        self.workers = alive
+        workers_count = self.workers_count
+        if workers_count is None:
+            workers_count = settings.SYNC_WORKERS
+        while len(self.workers) < workers_count:
+            t = threading.Thread(target=self._work,
+                                 name="sync-worker-%d" % next(self._worker_ids))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def _work(self):
+        while True:
+            self.process_next()
+
+    def process_next(self):
+        """ process a single queued job or wait for one; doesn't raise """
+        # the connection could have been broken meanwhile
+        close_old_connections()
+        try:
+            job_id = self.claim()
+        except Exception:
+            logger.exception("can't claim sync job")
+            job_id = None
+        if job_id is None:
+            with self.lock:
+                self.wakeup.wait(settings.SYNC_POLL_INTERVAL)
+            return
+        try:
+            self.run(job_id)
+        except Exception:
+            # e.g. database is not available, the job is abandoned then
+            logger.exception("failed to process sync job %s", job_id)
+
+    def claim(self):
+        """
+        pick a queued job and mark it as running
+
+        jobs are claimed only by the process which queued them, so it's enough that the update
+        of state is atomic: if more workers race for the same job, just one of them updates it
+
+        :return: int, id of the job, None if there is nothing to do
+        """
+        with self.lock:
+            # the oldest first
+            job_ids = sorted(self.tokens.keys())
+        for job_id in job_ids:
+            now = timezone.now()
+            claimed = SyncJob.objects.filter(id=job_id, state=SyncJob.QUEUED) \
+                .update(state=SyncJob.RUNNING, started=now, updated=now)
+            if claimed:
+                return job_id
+        return None
+
+    def run(self, job_id):
+        """
+        process a claimed job; it's always finished, unless database is not available: it's
+        abandoned then
+
+        :return: SyncJob, None if it couldn't be loaded
+        """
+        job = None
+        try:
+            job = SyncJob.objects.select_related("board").get(id=job_id)
+            with self.lock:
+                token = self.tokens[job_id]
+            logger.info("syncing board %s", job.board)
+            job.board.ensure_actions(token, progress=job.set_progress)
+            job.finish(SyncJob.DONE)
+        except Exception as ex:
+            logger.exception("failed to process sync job %s", job_id)
+            self.fail(job_id, ex)
+        finally:
+            with self.lock:
+                self.tokens.pop(job_id, None)
+        return job
+
+    @staticmethod
+    def fail(job_id, ex):
+        """ mark the job as failed, if database allows it """
+        now = timezone.now()
+        try:
+            SyncJob.objects.filter(id=job_id).update(
+                state=SyncJob.FAILED, error=error_message(ex), finished=now, updated=now)
+        except Exception:
+            logger.exception("can't mark sync job %s as failed", job_id)
+
+
+# shared by all requests in the process
+sync_queue = SyncQueue()
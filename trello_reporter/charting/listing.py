@@ -0,0 +1,84 @@
+"""
+Boards of users, as listed by trello
+
+Listing boards is a request to trello and boards rarely change, so the listing of every user is
+kept in memory of the process. When it's older than settings.BOARD_LIST_TTL, it's still used,
+but it's refreshed in background for the next time.
+"""
+
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+
+from trello_reporter.charting.models import Board
+
+
+logger = logging.getLogger(__name__)
+
+
+class BoardListing(object):
+    def __init__(self, ttl=None):
+        """
+        :param ttl: int, number of seconds a listing is fresh, defaults to
+                    settings.BOARD_LIST_TTL
+        """
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # user id -> (time of listing, list of board ids)
+        self.listings = {}
+        # ids of users whose boards are being listed right now
+        self.refreshing = set()
+
+    def get(self, user, token):
+        """
+        :return: list of Board, boards of the user
+        """
+        with self.lock:
+            listing = self.listings.get(user.id, None)
+        if listing is None:
+            return self.refresh(user, token)
+        listed_at, board_ids = listing
+        ttl = settings.BOARD_LIST_TTL if self.ttl is None else self.ttl
+        if time.time() - listed_at > ttl:
+            self.refresh_in_background(user, token)
+        boards = Board.objects.in_bulk(board_ids)
+        return [boards[board_id] for board_id in board_ids if board_id in boards]
+
+    def refresh(self, user, token):
+        """ list boards of the user in trello and store them """
+        boards = Board.list_boards(user, token)
+        with self.lock:
+            self.listings[user.id] = (time.time(), [board.id for board in boards])
+        return boards
+
+    def refresh_in_background(self, user, token):
+        with self.lock:
+            if user.id in self.refreshing:
+                return
+            self.refreshing.add(user.id)
+        logger.debug("refreshing boards of %s in background", user)
+        t = threading.Thread(target=self._refresh_and_finish, args=(user, token),
+                             name="refresh-boards-%s" % user.id)
+        t.daemon = True
+        t.start()
+
+    def _refresh_and_finish(self, user, token):
+        try:
+            self.refresh(user, token)
+        except Exception:
+            # the current listing stays, let's try again next time
+            logger.exception("failed to refresh boards of %s", user)
+        finally:
+            with self.lock:
+                self.refreshing.discard(user.id)
+            # every thread has its own database connection
+            connection.close()
+
+
+# shared by all requests in the process
+board_listing = BoardListing()
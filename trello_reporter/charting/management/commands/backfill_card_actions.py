@@ -0,0 +1,60 @@
+"""
+Fill denormalized columns of card actions stored before the columns existed
+
+The values are copied from CardActionEvent.data right inside database, the same way as
+CardAction.fields_from_event does it during processing.
+"""
+
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Max
+
+from trello_reporter.charting.models import CardAction
+from trello_reporter.harvesting.models import CardActionEvent
+
+
+BACKFILL_SQL = """
+UPDATE {card_action} AS ca SET
+    card_short_id = (e.data #>> '{{data,card,idShort}}')::integer,
+    list_before_trello_id = e.data #>> '{{data,listBefore,id}}',
+    list_before_name = left(e.data #>> '{{data,listBefore,name}}', 255),
+    list_after_trello_id = e.data #>> '{{data,listAfter,id}}',
+    list_after_name = left(e.data #>> '{{data,listAfter,name}}', 255),
+    is_rename = coalesce((e.data #> '{{data,old}}') ? 'name', false),
+    card_closed = coalesce((e.data #>> '{{data,card,closed}}')::boolean, false)
+FROM {event} AS e
+WHERE ca.event_id = e.id AND ca.id > %s AND ca.id <= %s
+"""
+
+# card actions which were not filled yet (or there is nothing to fill)
+MISSING_SQL = """
+    AND ca.card_short_id IS NULL AND ca.list_before_trello_id IS NULL
+    AND ca.list_after_trello_id IS NULL AND NOT ca.is_rename AND NOT ca.card_closed
+"""
+
+
+class Command(BaseCommand):
+    help = __doc__.strip().splitlines()[0]
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", default=False,
+                            help="fill all card actions, not just the ones which look empty")
+        parser.add_argument("--batch-size", type=int, default=10000,
+                            help="number of card actions updated in a single transaction")
+
+    def handle(self, *args, **options):
+        sql = BACKFILL_SQL.format(card_action=CardAction._meta.db_table,
+                                  event=CardActionEvent._meta.db_table)
+        if not options["all"]:
+            sql += MISSING_SQL
+        batch_size = options["batch_size"]
+        max_id = CardAction.objects.aggregate(Max("id"))["id__max"] or 0
+        updated = 0
+        for low in range(0, max_id, batch_size):
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, [low, low + batch_size])
+                    updated += cursor.rowcount
+        self.stdout.write("%d card actions were filled" % updated)
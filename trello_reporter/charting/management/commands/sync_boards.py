@@ -0,0 +1,46 @@
+"""
+Sync multiple boards with trello at once, e.g. nightly from cron
+
+Actions of the boards are fetched concurrently, see Board.ensure_actions_for_boards. Tokens are
+not stored, hence one has to be provided: --token or TRELLO_TOKEN environment variable.
+"""
+
+from __future__ import unicode_literals
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from trello_reporter.charting.models import Board
+
+
+class Command(BaseCommand):
+    help = __doc__.strip().splitlines()[0]
+
+    def add_arguments(self, parser):
+        parser.add_argument("trello_ids", nargs="*", metavar="TRELLO_ID",
+                            help="trello ids of boards to sync")
+        parser.add_argument("--all", action="store_true", default=False,
+                            help="sync all boards stored in database")
+        parser.add_argument("--token", default=os.getenv("TRELLO_TOKEN", None),
+                            help="trello token of a user who can access the boards")
+        parser.add_argument("--concurrency", type=int, default=None,
+                            help="number of boards fetched at once, "
+                                 "defaults to settings.HARVEST_CONCURRENCY")
+
+    def handle(self, *args, **options):
+        if not options["token"]:
+            raise CommandError("trello token is needed: --token or TRELLO_TOKEN")
+        if options["all"]:
+            boards = list(Board.objects.order_by("id"))
+        elif options["trello_ids"]:
+            boards = [Board.get_or_create_board(trello_id) for trello_id in options["trello_ids"]]
+        else:
+            raise CommandError("specify trello ids of boards or --all")
+
+        failed = Board.ensure_actions_for_boards(boards, options["token"],
+                                                 concurrency=options["concurrency"])
+        self.stdout.write("%d boards were synced" % (len(boards) - len(failed)))
+        if failed:
+            raise CommandError("failed to sync boards: %s" % ", ".join(
+                "%s (%s)" % (board, failed[board]) for board in boards if board in failed))
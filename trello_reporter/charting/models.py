@@ -7,22 +7,24 @@ notes:
 
 from __future__ import unicode_literals
 
+import bisect
+import itertools
 import logging
 import re
 
 from django.dispatch.dispatcher import receiver
 from django.utils.dateparse import parse_datetime
 
-from trello_reporter.charting.constants import SPRINT_CARDS_ACTIVE, MAX_STORY_POINTS
+from trello_reporter.charting.constants import SPRINT_CARDS_ACTIVE
 from .constants import DATETIME_FORMAT
 from trello_reporter.authentication.models import TrelloUser, KeyVal
-from trello_reporter.harvesting.harvestor import Harvestor
+from trello_reporter.harvesting.harvestor import Harvestor, ConcurrentHarvestor
 from trello_reporter.harvesting.models import CardActionEvent
 
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models, transaction
+from django.db import models, transaction, connection
 from django.db.utils import DatabaseError
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.utils import timezone
 
 
@@ -37,6 +39,39 @@ class BoardManager(models.Manager):
     def by_id(self, board_id):
         return self.get(id=board_id)
 
+    def sync_boards(self, user, boards_json):
+        """
+        store boards listed by trello and map them to the user; nothing is written when
+        nothing changed
+
+        :param boards_json: list of dicts, boards as returned by trello
+        :return: list of Board, in the same order as boards_json
+        """
+        trello_ids = [b["id"] for b in boards_json]
+        boards = {b.trello_id: b for b in self.filter(trello_id__in=trello_ids)}
+        new_boards = []
+        for board_json in boards_json:
+            board = boards.get(board_json["id"], None)
+            if board is None:
+                board = Board(trello_id=board_json["id"], name=board_json["name"])
+                boards[board.trello_id] = board
+                new_boards.append(board)
+            elif board_json["name"] and board.name != board_json["name"]:
+                board.name = board_json["name"]
+                board.save(update_fields=["name"])
+        if new_boards:
+            logger.info("storing %d new boards", len(new_boards))
+            self.bulk_create(new_boards)
+
+        mapped = set(BoardUserMapping.objects
+                     .filter(user=user, board__in=boards.values())
+                     .values_list("board_id", flat=True))
+        new_mappings = [BoardUserMapping(board=board, user=user)
+                        for board in boards.values() if board.id not in mapped]
+        if new_mappings:
+            BoardUserMapping.objects.bulk_create(new_mappings)
+        return [boards[trello_id] for trello_id in trello_ids]
+
     def by_id_cached(self, board_id):
         return self.filter(id=board_id).prefetch_related("card_actions")[0]
 
@@ -44,6 +79,8 @@ class BoardManager(models.Manager):
 class Board(models.Model):
     trello_id = models.CharField(max_length=32, db_index=True)
     name = models.CharField(max_length=255, null=True)
+    # bumped whenever data the charts are computed from change
+    data_version = models.IntegerField(default=0)
 
     objects = BoardManager.from_queryset(BoardQuerySet)()
 
@@ -53,63 +90,217 @@ class Board(models.Model):
     @classmethod
     def list_boards(cls, user, token):
         """
-        list boards for currently logged in user
+        list boards for currently logged in user, right from trello; see BoardListing
 
-        :return: boards query
+        :return: list of Board
         """
-        response = []
         # FIXME: decouple
         boards_json = Harvestor(token).list_boards()
-        for board_json in boards_json:
-            board = cls.get_or_create_board(board_json["id"], name=board_json["name"])
-            BoardUserMapping.get_or_create(board, user)
-            response.append(board)
-        return response
+        return cls.objects.sync_boards(user, boards_json)
 
     @classmethod
     def get_or_create_board(cls, trello_id, name=None):
         obj, created = cls.objects.get_or_create(trello_id=trello_id)
         if name and obj.name != name:
             obj.name = name
-        obj.save()
+            # don't overwrite data_version, it can be bumped meanwhile
+            obj.save(update_fields=["name"])
         return obj
 
-    def ensure_actions(self, token):
+    def bump_data_version(self):
+        """ data of the board changed, computed charts are not valid anymore """
+        Board.objects.filter(id=self.id).update(data_version=models.F("data_version") + 1)
+        self.data_version = Board.objects.filter(id=self.id) \
+            .values_list("data_version", flat=True).get()
+
+    def ensure_actions(self, token, progress=None):
         """
         ensure that card actions were fetched and loaded inside database; if not, load them
+
+        :param progress: callable, progress(processed, fetched), called while actions are loaded
         """
         h = Harvestor(token)
+        spool, actions = self.fetch_actions(h, self.latest_action_date())
+        self.load_actions(token, spool, actions, progress=progress)
+
+    @classmethod
+    def ensure_actions_for_boards(cls, boards, token, concurrency=None):
+        """
+        ensure_actions for multiple boards: actions are fetched from trello concurrently, but
+        loaded inside database one board at a time; a board which fails doesn't stop the others
+
+        :param boards: list of Board
+        :param concurrency: int, number of boards fetched at once
+        :return: dict, Board -> exception, boards which failed to sync
+        """
+        boards = list(boards)
+        since_list = [board.latest_action_date() for board in boards]
+
+        def fetch(harvestor, board_and_since):
+            board, since = board_and_since
+            try:
+                return board.fetch_actions(harvestor, since)
+            except Exception as ex:
+                logger.exception("failed to fetch actions of board %s", board)
+                return ex
+
+        h = ConcurrentHarvestor(token, concurrency=concurrency)
+        fetched = h.map(fetch, zip(boards, since_list))
+        failed = {}
         try:
-            latest_action = self.card_actions.latest()
+            for board, result in zip(boards, fetched):
+                if isinstance(result, Exception):
+                    failed[board] = result
+                    continue
+                spool, actions = result
+                logger.info("loading actions of board %s", board)
+                try:
+                    board.load_actions(token, spool, actions)
+                except Exception as ex:
+                    logger.exception("failed to load actions of board %s", board)
+                    failed[board] = ex
+        finally:
+            # spools of boards which were not loaded are still open
+            for result in fetched:
+                if not isinstance(result, Exception):
+                    result[0].close()
+        return failed
+
+    def latest_action_date(self):
+        """ date of the latest action stored in database, None if there are no actions """
+        try:
+            return self.card_actions.latest().date
         except ObjectDoesNotExist:
+            return None
+
+    def fetch_actions(self, h, since):
+        """
+        fetch actions from trello; doesn't touch database
+
+        :param h: Harvestor
+        :param since: datetime or None to fetch everything
+        :return: tuple, (ActionSpool, iterable of actions to load)
+        """
+        if since is None:
             logger.info("fetching all card actions")
-            actions = h.get_card_actions(self.trello_id)
-            initial_cards = h.get_cards_on_board(self.trello_id, actions[0]["date"])
-            # these are synthetic events
-            for c in sorted(initial_cards, key=lambda x: x["dateLastActivity"], reverse=True):
-                actions.insert(0, {
-                    "date": c["dateLastActivity"],
-                    "type": "defaultCard",
-                    "data": {
-                        "board": {
-                            "id": c["idBoard"]
-                        },
-                        "card": {
-                            "id": c["id"],
-                            "name": c["name"],
-                        },
-                        "list": {
-                            "id": c["idList"]
+            spool = h.spool_card_actions(self.trello_id)
+            oldest_action = spool.oldest
+            try:
+                initial_cards = h.get_cards_on_board(
+                    self.trello_id, oldest_action["date"] if oldest_action else None)
+                # these are synthetic events
+                default_cards = []
+                for c in sorted(initial_cards, key=lambda x: x["dateLastActivity"],
+                                reverse=True):
+                    default_cards.insert(0, {
+                        "date": c["dateLastActivity"],
+                        "type": "defaultCard",
+                        "data": {
+                            "board": {
+                                "id": c["idBoard"]
+                            },
+                            "card": {
+                                "id": c["id"],
+                                "name": c["name"],
+                            },
+                            "list": {
+                                "id": c["idList"]
+                            }
                         }
-                    }
-                })
+                    })
+                actions = itertools.chain(default_cards, spool)
+            except Exception:
+                spool.close()
+                raise
         else:
-            logger.info("fetching card actions since %s", latest_action.date)
-            actions = h.get_card_actions(self.trello_id, since=latest_action.date)
+            logger.info("fetching card actions since %s", since)
+            spool = h.spool_card_actions(self.trello_id, since=since)
+            actions = spool
+        return spool, actions
+
+    def load_actions(self, token, spool, actions, progress=None):
+        """ load fetched actions inside database and recalculate sprints """
+        # these import models
+        from trello_reporter.charting.ingestion import Ingestor
+        from trello_reporter.charting.timeline import BoardTimeline
+
+        def on_chunk(processed):
+            if progress is not None:
+                progress(processed, len(spool))
+
+        ingestor = Ingestor(self, progress=on_chunk)
+        try:
+            with spool:
+                logger.info("%d card actions fetched", len(spool))
+                ingestor.ingest(actions)
+                logger.debug("%d card actions stored", ingestor.stored)
+            Sprint.refresh(self, token)
+            Sprint.set_completed_list(self)
+        finally:
+            # even a part of actions could have been stored; changes of sprints bump the
+            # version on their own
+            if ingestor.stored:
+                self.bump_data_version()
+                BoardTimeline.invalidate(self)
+
+
+class SyncJobQuerySet(models.QuerySet):
+    def for_board(self, board):
+        return self.filter(board=board)
+
+    def active(self):
+        return self.filter(state__in=(SyncJob.QUEUED, SyncJob.RUNNING))
+
+
+class SyncJob(models.Model):
+    """ synchronization of a board with trello, processed in background: see charting.jobs """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATES = (
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    )
+
+    board = models.ForeignKey(Board, models.CASCADE, related_name="sync_jobs")
+    # who asked for it; it's processed with their token
+    user = models.ForeignKey(TrelloUser, models.SET_NULL, blank=True, null=True)
+    state = models.CharField(max_length=15, choices=STATES, default=QUEUED)
+    created = models.DateTimeField(default=timezone.now)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    # the latest sign of life of the job
+    updated = models.DateTimeField(default=timezone.now)
+    # number of processed and fetched card actions
+    processed = models.IntegerField(default=0)
+    total = models.IntegerField(blank=True, null=True)
+    error = models.TextField(blank=True, null=True)
+
+    objects = models.Manager.from_queryset(SyncJobQuerySet)()
 
-        CardAction.from_trello_response_list(self, actions)
-        Sprint.refresh(self, token)
-        Sprint.set_completed_list(self)
+    class Meta:
+        index_together = ("board", "state")
+        get_latest_by = "created"
+
+    def __unicode__(self):
+        return "%s: %s (%s)" % (self.id, self.board, self.state)
+
+    @property
+    def is_active(self):
+        return self.state in (self.QUEUED, self.RUNNING)
+
+    def set_progress(self, processed, total):
+        self.processed, self.total = processed, total
+        SyncJob.objects.filter(id=self.id).update(processed=processed, total=total,
+                                                  updated=timezone.now())
+
+    def finish(self, state, error=None):
+        self.state, self.error = state, error
+        self.finished = self.updated = timezone.now()
+        self.save(update_fields=["state", "error", "finished", "updated"])
 
 
 class BoardUserMapping(models.Model):
@@ -198,7 +389,7 @@ class Card(models.Model):
 
 class ListQuerySet(models.QuerySet):
     def for_board(self, board):
-        return self.filter(card_actions__board=board)
+        return self.filter(board_lists__board=board)
 
     def name_matches_re(self, regex):
         return self.filter(name__iregex=regex)
@@ -206,14 +397,12 @@ class ListQuerySet(models.QuerySet):
     def name_is_in(self, f):
         return self.filter(name__in=f)
 
-    def distinct_list(self):
-        return self.distinct("card_actions__list__name")
-
-    def latest_lists(self):
-        return self.order_by("card_actions__list__name", "-card_actions__date").distinct_list()
-
 
 class ListManager(models.Manager):
+    def _lists_in_registry(self, board_lists):
+        """ one list per name, the most recently used one """
+        return self.filter(id__in=list(board_lists.latest_by_name().values_list("list", flat=True)))
+
     def filter_lists_for_board(self, board, f=None):
         """
         filter lists for board
@@ -221,22 +410,22 @@ class ListManager(models.Manager):
         :param board:
         :param f: list of str or None
         """
-        query = self.for_board(board).latest_lists()
+        query = BoardList.objects.registry_for_board(board)
 
         if f:
             logger.debug("limiting lists to %s", f)
             query = query.name_is_in(f)
         else:
             query = query.filter(name__isnull=False)
-        return query
+        return self._lists_in_registry(query)
 
     def get_all_listnames_for_board(self, board):
-        return sorted(set(self.filter_lists_for_board(board).values_list("name", flat=True)))
+        query = BoardList.objects.registry_for_board(board).filter(name__isnull=False)
+        return sorted(set(query.values_list("name", flat=True)))
 
     def lists_for_board_match_regex(self, board, regex):
-        # distinct is important; it returns one entry per card action
-        lists = self.for_board(board).name_matches_re(regex).distinct_list()
-        return lists
+        query = BoardList.objects.registry_for_board(board).name_matches_re(regex)
+        return self._lists_in_registry(query)
 
     def sprint_archiving_lists_for_board(self, board):
         """ get lists which are used for archiving cards finished during a sprint """
@@ -280,6 +469,93 @@ class List(models.Model):
         return trello_list
 
 
+class BoardListQuerySet(models.QuerySet):
+    def for_board(self, board):
+        return self.filter(board=board)
+
+    def name_matches_re(self, regex):
+        return self.filter(name__iregex=regex)
+
+    def name_is_in(self, f):
+        return self.filter(name__in=f)
+
+    def latest_by_name(self):
+        return self.order_by("name", "-last_seen").distinct("name")
+
+
+class BoardListManager(models.Manager):
+    def registry_for_board(self, board):
+        """ lists of the board; the registry is built on first use """
+        self.ensure_for_board(board)
+        return self.for_board(board)
+
+    def ensure_for_board(self, board):
+        """ build registry of a board which was processed before registry existed """
+        if self.for_board(board).exists():
+            return
+        if CardAction.objects.for_board(board).exists():
+            self.rebuild(board)
+
+    def rebuild(self, board):
+        """ (re)create registry of the board from its card actions """
+        logger.info("building registry of lists for board %s", board)
+        rows = CardAction.objects.for_board(board) \
+            .filter(list__isnull=False) \
+            .values("list", "list__name") \
+            .annotate(last_seen=models.Max("date"))
+        with transaction.atomic():
+            self.for_board(board).delete()
+            self.bulk_create([
+                BoardList(board=board, list_id=row["list"], name=row["list__name"],
+                          last_seen=row["last_seen"])
+                for row in rows
+            ])
+
+    def update_for_board(self, board, seen):
+        """
+        :param board: Board
+        :param seen: dict, List -> date of the latest card action on the list
+        """
+        if not seen:
+            return
+        existing = {bl.list_id: bl for bl in self.for_board(board).filter(
+            list__in=[li.id for li in seen])}
+        new = []
+        for li, date in seen.items():
+            bl = existing.get(li.id, None)
+            if bl is None:
+                new.append(BoardList(board=board, list=li, name=li.name, last_seen=date))
+            elif bl.last_seen < date or bl.name != li.name:
+                bl.last_seen = max(bl.last_seen, date)
+                bl.name = li.name
+                bl.save(update_fields=["last_seen", "name"])
+        self.bulk_create(new)
+
+
+class BoardList(models.Model):
+    """
+    registry of lists on a board, maintained during processing of card actions
+
+    List doesn't know its board, this is much cheaper than going through card actions
+    """
+    board = models.ForeignKey(Board, models.CASCADE, related_name="board_lists")
+    list = models.ForeignKey(List, models.CASCADE, related_name="board_lists")
+    # current name of the list
+    name = models.CharField(max_length=255, blank=True, null=True)
+    # date of the latest card action on the list
+    last_seen = models.DateTimeField()
+
+    objects = BoardListManager.from_queryset(BoardListQuerySet)()
+
+    class Meta:
+        unique_together = ("board", "list")
+        index_together = ("board", "name")
+        get_latest_by = "last_seen"
+
+    def __unicode__(self):
+        return "%s: %s" % (self.board, self.list)
+
+
 class ListStatQuerySet(models.QuerySet):
     def for_board(self, board):
         return self.filter(card_action__board=board)
@@ -303,23 +579,36 @@ class ListStatQuerySet(models.QuerySet):
     def unique_card(self):
         return self.order_by('card_action__card', '-card_action__date').distinct('card_action__card')
 
+    def latest_for_lists(self, list_ids):
+        """ the latest stat of every list """
+        return self.for_lists(list_ids).order_by("list", "-card_action__date", "-id") \
+            .distinct("list")
+
     def unique_list(self):
         """ don't duplicate lists """
         # here we care about list names, not list instances
-        return self.order_by('list__name', '-card_action__date').distinct('list__name')
+        return self.order_by('list__name', '-card_action__date', '-id').distinct('list__name')
 
 
 class ListStatManager(models.Manager):
     def latest_stat_for_list(self, li):
-        return self.for_list(li).latest()
+        # an action can have two stats for the same list (-1 and +1), the later one wins
+        return self.for_list(li).order_by("-card_action__date", "-id")[:1].get()
 
     def for_list_order_by_date(self, li):
         return self.for_list(li).order_by("-card_action__date").select_related(
             "card_action", "card_action__card")
 
     def for_list_in_range(self, li, beginning, end):
-        return self.for_list_order_by_date(li).in_range(beginning, end).select_related(
-            "card_action", "card_action__card", "card_action__event")
+        """ the latest first; only columns of card actions are loaded, not their events """
+        return self \
+            .for_list(li) \
+            .in_range(beginning, end) \
+            .order_by("-card_action__date") \
+            .select_related("card_action") \
+            .only("list", "diff", "cards_rt", "story_points_rt", "card_action__date",
+                  "card_action__action_type", "card_action__card_short_id",
+                  "card_action__card")
 
     def stats_for_lists_in_range(self, list_ids, beginning, end):
         return self \
@@ -342,6 +631,38 @@ class ListStatManager(models.Manager):
            .before(before) \
            .unique_list()
 
+    def stats_for_list_names_at(self, board, list_names, dates):
+        """
+        stats_for_list_names_before for many dates at once, in a single query
+
+        :return: list with an item for every date: list of tuples
+                 (list name, cards_rt, story_points_rt)
+        """
+        sql = """
+SELECT d.idx, n.name, s.cards_rt, s.story_points_rt
+FROM unnest(%s::timestamptz[]) WITH ORDINALITY AS d(date, idx)
+CROSS JOIN unnest(%s::text[]) AS n(name)
+CROSS JOIN LATERAL (
+    SELECT ls.cards_rt, ls.story_points_rt
+    FROM {list_stat} AS ls
+    JOIN {card_action} AS ca ON ca.id = ls.card_action_id
+    JOIN {list} AS li ON li.id = ls.list_id
+    WHERE ca.board_id = %s AND li.name = n.name AND ca.date < d.date
+    ORDER BY ca.date DESC, ls.id DESC
+    LIMIT 1
+) AS s
+ORDER BY d.idx, n.name
+""".format(list_stat=ListStat._meta.db_table, card_action=CardAction._meta.db_table,
+           list=List._meta.db_table)
+        response = [[] for _ in dates]
+        if not dates or not list_names:
+            return response
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [list(dates), list(list_names), board.id])
+            for idx, name, cards_rt, story_points_rt in cursor.fetchall():
+                response[idx - 1].append((name, cards_rt, story_points_rt))
+        return response
+
     def sum_cards_for_list_names_before(self, board, list_names, before):
         # NotImplementedError: aggregate() + distinct(fields) not implemented.
         return sum([x.cards_rt for x in self.stats_for_list_names_before(
@@ -439,10 +760,18 @@ class CardActionQuerySet(models.QuerySet):
 class CardActionManager(models.Manager):
     def get_card_actions_on_board_in(self, board, date=None):
         """ this is a time machine: shows board state in a given time """
+        if date is None:
+            return self.present_card_actions_on_board(board)
         query = self.for_board(board).distinct_cards()
         if date:
             query = query.before(date)
-        return query.select_related("list", "card", "board", "event")
+        return query.select_related("list", "card", "board")
+
+    def present_card_actions_on_board(self, board):
+        """ latest card action of every card on board, see CardState """
+        CardState.objects.ensure_for_board(board)
+        return self.filter(state__board=board).order_by("card").select_related(
+            "list", "card", "board")
 
     def actions_on_board_in_range(self, board, beginning, end):
         """ show actions based on range, beginning and end can be None """
@@ -456,17 +785,19 @@ class CardActionManager(models.Manager):
         elif end:
             query = query.before(end)
 
-        return query.select_related("list", "card", "board", "event")
+        return query.select_related("list", "card", "board")
 
     def card_actions_on_list_names_in(self, board, list_names, date=None):
+        if date is None:
+            return self.present_card_actions_on_board(board).for_list_names(list_names)
         cas = self.get_card_actions_on_board_in(board, date=date)
         return self.filter(id__in=[x.id for x in cas], list__name__in=list_names).select_related(
-            "list", "card", "board", "event"
+            "list", "card", "board"
         )
 
     def card_actions_for_cards(self, card_ids):
         cas = self.for_cards(card_ids).distinct_cards().select_related(
-            "list", "card", "board", "event"
+            "list", "card", "board"
         )
         return cas
 
@@ -476,7 +807,32 @@ class CardActionManager(models.Manager):
             .since(beginning) \
             .for_list_names(list_names) \
             .filter(id__in=[x.id for x in cas]) \
-            .select_related("list", "card", "board", "event")
+            .select_related("list", "card", "board")
+
+    def latest_card_actions_in_windows(self, board, dates, delta):
+        """
+        time machine for many consecutive windows [date - delta, date] at once: latest card
+        action (as of date) of every card which has an action in the window
+
+        :param dates: list of datetimes, ascending
+        :param delta: timedelta
+        :return: list with an item for every date: list of CardAction, ordered by date
+        """
+        if not dates:
+            return []
+        cas = list(self.for_board(board)
+                   .in_range(dates[0] - delta, dates[-1])
+                   .order_by("date", "id")
+                   .select_related("list", "card"))
+        action_dates = [ca.date for ca in cas]
+        response = []
+        for d in dates:
+            latest = {}
+            for ca in cas[bisect.bisect_left(action_dates, d - delta):
+                          bisect.bisect_right(action_dates, d)]:
+                latest[ca.card_id] = ca
+            response.append(sorted(latest.values(), key=lambda x: (x.date, x.id)))
+        return response
 
     def card_actions_on_list_names_in_interval(self, board, list_names, beginning, end):
         cas = self.actions_on_board_in_range(board, beginning, end)
@@ -488,9 +844,11 @@ class CardActionManager(models.Manager):
 
     def safe_card_actions_on_list_in(self, board, li, date=None):
         """ aggregate + distinct is not implemented """
+        if date is None:
+            return self.present_card_actions_on_board(board).filter(list=li)
         cas = self.get_card_actions_on_board_in(board, date=date)
         return self.filter(id__in=[x.id for x in cas], list=li).select_related("card", "board",
-                                                                               "event", "list")
+                                                                               "list")
 
     def story_points_on_list_in(self, board, li, date):
         return self.safe_card_actions_on_list_in(board, li, date) \
@@ -542,6 +900,15 @@ class CardAction(models.Model):
 
     event = models.OneToOneField(CardActionEvent, models.CASCADE, related_name="card_action")
 
+    # copied from event, so that charts don't need to touch events; see fields_from_event
+    card_short_id = models.IntegerField(blank=True, null=True)
+    list_before_trello_id = models.CharField(max_length=32, blank=True, null=True)
+    list_before_name = models.CharField(max_length=255, blank=True, null=True)
+    list_after_trello_id = models.CharField(max_length=32, blank=True, null=True)
+    list_after_name = models.CharField(max_length=255, blank=True, null=True)
+    is_rename = models.BooleanField(default=False)
+    card_closed = models.BooleanField(default=False)
+
     objects = CardActionManager.from_queryset(CardActionQuerySet)()
 
     class Meta:
@@ -562,6 +929,28 @@ class CardAction(models.Model):
     def trello_board_id(self):
         return self.board.trello_id
 
+    @staticmethod
+    def fields_from_event(view):
+        """
+        values of denormalized fields; keep in sync with backfill_card_actions command
+
+        :param view: EventView
+        :return: dict
+        """
+        return {
+            "card_short_id": view.card_short_id,
+            "list_before_trello_id": view.list_before_id,
+            "list_before_name": view.list_before_name and view.list_before_name[:255],
+            "list_after_trello_id": view.list_after_id,
+            "list_after_name": view.list_after_name and view.list_after_name[:255],
+            "is_rename": view.rename,
+            "card_closed": bool(view.card_closed),
+        }
+
+    @property
+    def card_url(self):
+        return "https://trello.com/c/%s" % self.card.trello_id
+
     @property
     def data(self):
         """ backwards compat """
@@ -569,8 +958,8 @@ class CardAction(models.Model):
 
     @property
     def list_id_and_name(self):
-        d = self.data["data"].get("list", {})
-        return d.get("id", None), d.get("name", None)
+        view = self.event.view
+        return view.list_id, view.list_name
 
     @property
     def list_name(self):
@@ -579,56 +968,39 @@ class CardAction(models.Model):
     @property
     def source_list_name(self):
         """ get source list name for movement actions """
-        return self.data["data"]["listBefore"]["name"]
+        return self.list_before_name
 
     @property
     def is_a_list_change(self):
-        return "listBefore" in self.data["data"]
+        return self.list_before_trello_id is not None
 
     @property
     def source_list_id(self):
         """ get source list name for movement actions """
-        return self.data["data"]["listBefore"]["id"]
+        return self.list_before_trello_id
 
     @property
     def target_list_id_and_name(self):
-        d = self.data["data"].get("listAfter", {})
-        return d.get("id", None), d.get("name", None)
+        return self.list_after_trello_id, self.list_after_name
 
     @property
     def target_list_name(self):
         """ get target list name for movement actions """
-        return self.data["data"]["listAfter"]["name"]
+        return self.list_after_name
 
     @property
     def rename(self):
-        try:
-            self.data["data"]["old"]["name"]
-        except KeyError:
-            return False
-        else:
-            return True
+        return self.is_rename
 
     @property
     def opening(self):
         """ does this action opens (sends to board) the card? """
-        try:
-            return self.data["data"]["old"]["closed"]
-        except KeyError:
-            return False
+        return self.event.view.opening
 
     @property
     def archiving(self):
         """ does this action closes (archives) the card? """
-        try:
-            was_closed = self.data["data"]["old"]["closed"]
-        except KeyError:
-            was_closed = True
-        try:
-            is_closed = self.data["data"]["card"]["closed"]
-        except KeyError:
-            is_closed = False
-        return is_closed or not was_closed
+        return self.event.view.archiving
 
     @property
     def card_name(self):
@@ -655,130 +1027,84 @@ class CardAction(models.Model):
         except IndexError:
             return None
 
-    # TODO: this takes minutes!!! move it to a different module and minimize database queries
     @classmethod
-    def from_trello_response_list(cls, board, actions):
-        logger.debug("processing %d actions", len(actions))
-        for action_data in actions:
-            with transaction.atomic():
-                card, _ = Card.objects.get_or_create(trello_id=action_data["data"]["card"]["id"])
-                card.save()
-
-                event = CardActionEvent(data=action_data)
-                event.save()
-                ca = CardAction(
-                    trello_id=action_data.get("id", None),
-                    date=parse_datetime(action_data["date"]),
-                    action_type=action_data["type"],
-                    card=card,
-                    event=event,
-                    board=board  # TODO: use board from action_data
-                )
-
-                if ca.card_name and card.name != ca.card_name:
-                    card.name = ca.card_name[:255]  # some users are just fun
-                    card.save()
-
-                previous_action = CardAction.objects.latest_for_card(card)
-                story_points_str = CardAction.get_story_points(ca.card_name)
-                story_points_int = 0
-                if story_points_str is not None:
-                    story_points_int = int(story_points_str)
-                    ca.story_points = story_points_int if story_points_int <= MAX_STORY_POINTS \
-                        else MAX_STORY_POINTS
-
-                # figure out list_name, archivals, removals and unicorns
-                if ca.action_type in ["createCard", "moveCardToBoard", "defaultCard",
-                                      "copyCard", "convertToCardFromCheckItem"]:  # create-like events
-                    if ca.trello_board_id != board.trello_id:
-                        logger.info("card %s was created on board %s",
-                                    ca.trello_card_id, ca.trello_board_id)
-                        # we don't care about such state
-                        continue
-                    # when list is changed (or on different board), name is missing; fun stuff!
-                    trello_list_id, list_name = ca.list_id_and_name
-                    if not trello_list_id:
-                        logger.warning("list not specified for card '%s'", card.name)
-                        # wat?! how about telling us to which list this is going
-                        continue
-                    ca.list = List.get_or_create_list(trello_list_id, list_name)
-
-                elif ca.action_type in ["updateCard"]:  # update = change list, board, close or open
-                    if ca.archiving:
-                        ca.list = None
-                        ca.is_archived = True
-                    elif ca.opening or ca.rename:
-                        # card is opened again
-                        trello_list_id, list_name = ca.list_id_and_name
-                        if not trello_list_id:
-                            logger.warning("card updated to unknown list: %s", ca)
-                            # cards without lists are useless to us; srsly trello?!
-                            continue
-                        ca.list = List.get_or_create_list(trello_list_id, list_name)
-                        if previous_action:
-                            if previous_action.list != ca.list:
-                                logger.info("sneaky list change %s: %s -> %s", card, previous_action.list, ca.list)
-                            elif ca.story_points == previous_action.story_points:
-                                # just name update, we don't care about that
-                                continue
-                    else:
-                        if previous_action and previous_action.is_archived:
-                            logger.info("archived card %s is being moved", card)
-                            continue
-                        trello_list_id, list_name = ca.target_list_id_and_name
-                        ca.list = List.get_or_create_list(trello_list_id, list_name)
-
-                elif ca.action_type in ["moveCardFromBoard", "deleteCard"]:  # delete
-                    if previous_action:
-                        ca.list = None
-                        ca.is_deleted = True
-                    else:
-                        logger.info("card %s (%s) has unknown previous state",
-                                    ca.trello_card_id, ca.card_name)
-                        # default card?
-                        continue
+    def from_trello_response_list(cls, board, actions, progress=None):
+        """
+        process actions fetched from trello and store them in database
 
-                event.processed_well = True
-                event.save()
-                ca.save()
+        :param board: Board
+        :param actions: iterable of json-like structures, oldest first
+        :param progress: callable, called with number of processed actions after every chunk
+        """
+        # ingestion imports models
+        from trello_reporter.charting.ingestion import Ingestor
+        count = Ingestor(board, progress=progress).ingest(actions)
+        logger.debug("processed %d actions", count)
 
-                # ListStats
-                if ca.rename and previous_action and previous_action.list == ca.list:
-                    diff = 0
-                    try:
-                        current_list_stat = ListStat.objects.latest_stat_for_list(ca.list)
-                        cards_rt = current_list_stat.cards_rt
-                        sp_rt = current_list_stat.story_points_rt
-                    except ObjectDoesNotExist:
-                        cards_rt = 0
-                        sp_rt = 0
-                    previous_points = getattr(previous_action, "story_points", 0)
-                    ListStat.create_stat(ca, ca.list, diff, cards_rt,
-                                         sp_rt - previous_points + story_points_int)
-                else:
-                    if previous_action:
-                        diff = -1
-                        previous_list = previous_action.list
-                        if previous_list:
-                            if previous_list == ca.list:
-                                # HACK: likely trello trashed an event of moving the card
-                                logger.warning("card %s is already on list %s", card, previous_list)
-                            previous_list_stat = ListStat.objects.latest_stat_for_list(previous_list)
-                            cards_rt = previous_list_stat.cards_rt
-                            sp_rt = previous_list_stat.story_points_rt
-                            ListStat.create_stat(ca, previous_list, diff, cards_rt + diff,
-                                                 sp_rt - previous_action.story_points)
-                    if ca.list and not (ca.is_archived or ca.is_deleted):
-                        diff = 1
-                        try:
-                            current_list_stat = ListStat.objects.latest_stat_for_list(ca.list)
-                            cards_rt = current_list_stat.cards_rt
-                            sp_rt = current_list_stat.story_points_rt
-                        except ObjectDoesNotExist:
-                            cards_rt = 0
-                            sp_rt = 0
-                        ListStat.create_stat(ca, ca.list, diff, cards_rt + diff,
-                                             sp_rt + story_points_int)
+
+class CardStateQuerySet(models.QuerySet):
+    def for_board(self, board):
+        return self.filter(board=board)
+
+
+class CardStateManager(models.Manager):
+    def ensure_for_board(self, board):
+        """ build state of a board which was processed before this table existed """
+        if self.for_board(board).exists():
+            return
+        if CardAction.objects.for_board(board).exists():
+            self.rebuild(board)
+
+    def rebuild(self, board):
+        """ (re)create state of the board from its card actions """
+        logger.info("building present state of board %s", board)
+        # the same card action the ingestion ends up with: the last one processed wins a tie
+        cas = CardAction.objects.for_board(board).order_by("card", "-date", "-id") \
+            .distinct("card")
+        with transaction.atomic():
+            self.for_board(board).delete()
+            self.bulk_create([CardState.from_card_action(ca) for ca in cas], batch_size=1000)
+
+    def update_for_board(self, board, card_actions):
+        """
+        :param board: Board
+        :param card_actions: list of CardAction, the latest stored action of every changed card
+        """
+        if not card_actions:
+            return
+        self.for_board(board).filter(card__in=[ca.card_id for ca in card_actions]).delete()
+        self.bulk_create([CardState.from_card_action(ca) for ca in card_actions],
+                         batch_size=1000)
+
+
+class CardState(models.Model):
+    """
+    present state of a card on a board, maintained during processing of card actions
+
+    the same as latest CardAction of the card, but without going through all the actions
+    """
+    board = models.ForeignKey(Board, models.CASCADE, related_name="card_states")
+    card = models.ForeignKey(Card, models.CASCADE, related_name="states")
+    card_action = models.OneToOneField(CardAction, models.CASCADE, related_name="state")
+    list = models.ForeignKey(List, models.CASCADE, null=True, blank=True,
+                             related_name="card_states")
+    story_points = models.IntegerField(null=True, default=0)
+    is_archived = models.BooleanField(default=False)
+    is_deleted = models.BooleanField(default=False)
+
+    objects = CardStateManager.from_queryset(CardStateQuerySet)()
+
+    class Meta:
+        unique_together = ("board", "card")
+
+    def __unicode__(self):
+        return "%s: %s" % (self.card_id, self.card_action_id)
+
+    @classmethod
+    def from_card_action(cls, ca):
+        return cls(board_id=ca.board_id, card_id=ca.card_id, card_action_id=ca.id,
+                   list_id=ca.list_id, story_points=ca.story_points,
+                   is_archived=ca.is_archived, is_deleted=ca.is_deleted)
 
 
 class SprintQuerySet(models.QuerySet):
@@ -822,6 +1148,35 @@ class SprintManager(models.Manager):
         except ObjectDoesNotExist:
             return None
 
+    def story_points_of_sprints(self, sprints, commitment_cols):
+        """
+        Sprint.story_points_committed and Sprint.story_points_done for many sprints at once
+
+        :param sprints: list of Sprint
+        :param commitment_cols: list of str, names of lists
+        :return: dict, Sprint.id -> (story points committed, story points done)
+        """
+        committed = {}
+        by_board = {}
+        for sprint in sprints:
+            if sprint.start_dt is None:
+                committed[sprint.id] = sprint.story_points_committed(commitment_cols)
+            else:
+                by_board.setdefault(sprint.board_id, []).append(sprint)
+        for board_sprints in by_board.values():
+            stats_at = ListStat.objects.stats_for_list_names_at(
+                board_sprints[0].board, commitment_cols, [x.start_dt for x in board_sprints])
+            for sprint, stats in zip(board_sprints, stats_at):
+                committed[sprint.id] = sum(filter(None, [sp for _, _, sp in stats]))
+
+        completed_list_ids = [x.completed_list_id for x in sprints if x.completed_list_id]
+        done = {stat.list_id: stat.story_points_rt
+                for stat in ListStat.objects.latest_for_lists(completed_list_ids)}
+        return {
+            sprint.id: (committed[sprint.id], done.get(sprint.completed_list_id, 0))
+            for sprint in sprints
+        }
+
 
 class Sprint(models.Model):
     """
@@ -843,9 +1198,27 @@ class Sprint(models.Model):
 
     objects = SprintManager.from_queryset(SprintQuerySet)()
 
+    # charts are computed from these; changing any of them bumps Board.data_version
+    CHART_FIELDS = ("start_dt", "end_dt", "name", "sprint_number", "completed_list_id",
+                    "due_card_id")
+
     class Meta:
         get_latest_by = "end_dt"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(Sprint, cls).from_db(db, field_names, values)
+        instance._stored_values = instance.chart_values()
+        return instance
+
+    def chart_values(self):
+        return tuple(getattr(self, f) for f in self.CHART_FIELDS)
+
+    @property
+    def chart_values_changed(self):
+        """ were the fields changed since the sprint was loaded or saved """
+        return getattr(self, "_stored_values", None) != self.chart_values()
+
     def __unicode__(self):
         tz = timezone.get_current_timezone()
         s = e = "<missing>"
@@ -881,7 +1254,7 @@ class Sprint(models.Model):
         """
         trello_card_ids = CardAction.objects.get_sprint_trello_card_ids(board)
 
-        due_dict = Harvestor(token).get_due_of_cards(trello_card_ids)
+        due_dict = Harvestor(token).get_due_of_cards_on_board(board.trello_id, trello_card_ids)
         due_list = due_dict.items()
 
         sprint_number_re = re.compile(r"(\d+)")
@@ -953,7 +1326,8 @@ class Sprint(models.Model):
         for sprint in Sprint.objects.filter(board=board, completed_list__isnull=True):
             regex = r"^\s*sprint %d" % sprint.sprint_number
             try:
-                li = List.objects.filter(card_actions__board=board, name__iregex=regex).latest("card_actions__date")
+                li = BoardList.objects.registry_for_board(board).name_matches_re(regex) \
+                    .select_related("list").latest().list
             except ObjectDoesNotExist:
                 logger.debug("it seems that sprint %s has not finished yet", sprint)
                 continue
@@ -965,3 +1339,21 @@ class Sprint(models.Model):
 @receiver(post_save, sender=Sprint)
 def set_sprint_cards_cb(instance, *args, **kwargs):
     instance.set_sprint_cards()
+
+
+def bump_board_data_version(sprint):
+    Board.objects.filter(id=sprint.board_id).update(data_version=models.F("data_version") + 1)
+
+
+# has to be registered after set_sprint_cards_cb, cards of the sprint are part of the change
+@receiver(post_save, sender=Sprint)
+def sprint_saved_cb(instance, created=False, *args, **kwargs):
+    # sprints are saved during every sync, even when nothing changed
+    if created or instance.chart_values_changed:
+        bump_board_data_version(instance)
+    instance._stored_values = instance.chart_values()
+
+
+@receiver(post_delete, sender=Sprint)
+def sprint_deleted_cb(instance, *args, **kwargs):
+    bump_board_data_version(instance)
@@ -12,10 +12,13 @@ import logging
 import datetime
 
 import itertools
+import numpy
+from django.conf import settings
 from django.utils import timezone
 
 from trello_reporter.charting.forms import CARDS_FORM_ID, STORY_POINTS_FORM_ID
-from trello_reporter.charting.models import CardAction, ListStat
+from trello_reporter.charting.models import BoardList, Card, CardAction, ListStat, Sprint
+from trello_reporter.charting.timeline import BoardTimeline
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +28,13 @@ def h_f(v):
     return "{:.1f}".format(v)
 
 
+def stats_for_list_names_at(board, list_names, dates):
+    """ ListStatManager.stats_for_list_names_at, answered from memory if enabled """
+    if settings.CHART_TIMELINE:
+        return BoardTimeline.for_board(board).stats_for_list_names_at(list_names, dates)
+    return ListStat.objects.stats_for_list_names_at(board, list_names, dates)
+
+
 class ChartExporter(object):
     """
     Export selected data as a chart for specific charting javascript library
@@ -42,21 +52,23 @@ class ChartExporter(object):
         response = []
 
         # c3 doesn't handle disconnected area segments, hence we need to cumulate
+        dates = []
         d = beginning
-        while True:
-            if d > end:
-                break
-            stats = ListStat.objects.stats_for_list_names_before(board, lists_filter, d)
+        while d <= end:
+            dates.append(d)
+            d += delta
+
+        stats_at = stats_for_list_names_at(board, lists_filter, dates)
+        for d, stats in zip(dates, stats_at):
             tick = {
                 "date": d.strftime("%Y-%m-%d %H:%M"),
             }
-            for s in stats:
+            for list_name, cards_rt, story_points_rt in stats:
                 if c_unit == CARDS_FORM_ID:
-                    tick[s.list.name] = s.cards_rt
+                    tick[list_name] = cards_rt
                 elif c_unit == STORY_POINTS_FORM_ID:
-                    tick[s.list.name] = s.story_points_rt
+                    tick[list_name] = story_points_rt
             response.append(tick)
-            d += delta
         return response
 
     @classmethod
@@ -68,29 +80,30 @@ class ChartExporter(object):
 
         response = []
         delta = datetime.timedelta(days=1)
+        dates = []
         d = beginning
-        while True:
-            if d > end:
-                break
-            if d > now:
-                response.append({"date": end.strftime("%Y-%m-%d %H:%M"), "ideal": 0})
-                break
-            prev = d - delta
-            compl = CardAction.objects.card_actions_on_list_names_in_range(
-                board, completed_lists, prev, d)
-            in_progress = ListStat.objects.sum_sp_for_list_names_before(
-                board, in_progress_list_names, d)
+        while d <= end and d <= now:
+            dates.append(d)
+            d += delta
+
+        # all the data are loaded at once, days are just windows over them
+        windows = CardAction.objects.latest_card_actions_in_windows(board, dates, delta)
+        stats_at = stats_for_list_names_at(board, in_progress_list_names, dates)
+        for date, window, stats in zip(dates, windows, stats_at):
+            compl = [x for x in window if x.list and x.list.name in completed_lists]
+            in_progress = sum(filter(None, [sp for _, _, sp in stats]))
             tick = {
-                "date": d.strftime("%Y-%m-%d %H:%M"),
+                "date": date.strftime("%Y-%m-%d %H:%M"),
                 "done": sum([x.story_points for x in compl]),
                 "not_done": in_progress,
                 "done_cards": [{"name": x.card.name, "id": x.card_id} for x in compl]
             }
             if len(response) == 0:
-                tick["ideal"] = ListStat.objects.sum_sp_for_list_names_before(
-                    board, in_progress_list_names, d)
+                tick["ideal"] = in_progress
             response.append(tick)
-            d += delta
+        if d <= end:
+            # the rest of the range is in future
+            response.append({"date": end.strftime("%Y-%m-%d %H:%M"), "ideal": 0})
         if response:
             response[-1]["ideal"] = 0
         return response
@@ -99,12 +112,14 @@ class ChartExporter(object):
     def velocity_chart_c3(cls, sprints, commitment_cols):
         response = []
         response_len = 0
+        sprints = list(sprints)
+        story_points = Sprint.objects.story_points_of_sprints(sprints, commitment_cols)
         for sprint in reversed(sprints):
             logger.debug("processing sprint %s", sprint)
-            done = sprint.story_points_done
+            committed, done = story_points[sprint.id]
             r = {
                 "done": done,
-                "committed": sprint.story_points_committed(commitment_cols),
+                "committed": committed,
                 "name": sprint.name,
             }
             # http://math.stackexchange.com/a/106314
@@ -122,17 +137,30 @@ class ChartExporter(object):
     @classmethod
     def list_history_chart_c3(cls, li, beginning, end):
         response = []
-        for ls in ListStat.objects.for_list_in_range(li, beginning, end):
+        board_lists = []
+        if settings.CHART_TIMELINE:
+            # a timeline has stats of a single board, but a list can be on more of them
+            board_lists = list(BoardList.objects.filter(list=li).select_related("board")[:2])
+        if len(board_lists) == 1:
+            history = BoardTimeline.for_board(board_lists[0].board).list_history_in_range(
+                li, beginning, end)
+        else:
+            history = [(ls.card_action.date, ls.cards_rt, ls.story_points_rt)
+                       for ls in ListStat.objects.for_list_in_range(li, beginning, end)]
+        for date, cards_rt, story_points_rt in history:
             r = {
-                "cards": ls.cards_rt,
-                "story_points": ls.story_points_rt,
-                "date": ls.card_action.date.strftime("%Y-%m-%d %H:%M")
+                "cards": cards_rt,
+                "story_points": story_points_rt,
+                "date": date.strftime("%Y-%m-%d %H:%M")
             }
             response.append(r)
         return response
 
 
 class ControlChart(object):
+    # number of cards in rolling average
+    ROLLING_WINDOW = 10
+
     def __init__(self, board, lists_filter, beginning, end):
         logger.debug("control chart: board %s, workflow %s, range %s - %s",
                      board, lists_filter, beginning, end)
@@ -148,71 +176,117 @@ class ControlChart(object):
             card_actions = CardAction.objects.card_actions_on_list_names_in_interval_order_desc(
                 self.board,
                 itertools.chain(*self.lists_filter),
-                self.beginning, self.end)
+                self.beginning, self.end) \
+                .order_by("-date", "-id") \
+                .values_list("card_id", "date", "list__name", "story_points", "card_short_id",
+                             "is_rename", "list_before_trello_id")
 
-            # card -> {
-            #  visited_idx: 3
-            #  data: [ca, ca, ...]
-            # }
+            # actions are walked from the latest: the workflow is matched from its end
+            # card id -> [
+            #   index of state we need to reach next, -1 = fulfilled
+            #   date, story points and short id of the action which reached the last state
+            #   date of the action which reached the first state
+            # ]
             card_history = {}
             lists_filter_len = len(self.lists_filter)
 
-            for ca in card_actions:
-                if ca.rename and not ca.is_a_list_change:
+            for (card_id, date, list_name, story_points, card_short_id,
+                 is_rename, list_before_trello_id) in card_actions.iterator():
+                if is_rename and list_before_trello_id is None:
                     # ignore card sizing events
                     continue
 
-                card = ca.card
-
-                card_data = card_history.get(card,
-                                             {"visited_idx": lists_filter_len - 1, "data": []})
-                card_history.setdefault(card, card_data)
-                if card_data["visited_idx"] == -1:
+                card_data = card_history.get(card_id, None)
+                if card_data is None:
+                    card_data = [lists_filter_len - 1, None, None, None, None]
+                    card_history[card_id] = card_data
+                visited_idx = card_data[0]
+                if visited_idx == -1:
                     # fulfilled
                     continue
-                needed_state = self.lists_filter[card_data["visited_idx"]]
-                assert isinstance(needed_state, list)
-                if ca.list.name in needed_state:  # we need to reach this one
-                    card_data["visited_idx"] -= 1
-                    card_data["data"].insert(0, ca)
+                if list_name in self.lists_filter[visited_idx]:  # we need to reach this one
+                    if visited_idx == lists_filter_len - 1:
+                        card_data[1:4] = date, story_points, card_short_id
+                    if visited_idx == 0:
+                        card_data[4] = date
+                    card_data[0] -= 1
+
+            valid_cards = {card_id: card_data
+                           for card_id, card_data in card_history.items()
+                           if card_data[0] == -1}
+            card_names = dict(Card.objects.filter(id__in=valid_cards.keys())
+                              .values_list("id", "name"))
 
             self._chart_data = []
-            valid_cards = {card: card_data
-                           for card, card_data in card_history.items()
-                           if card_data["visited_idx"] == -1}
-
-            for card, card_data in valid_cards.items():
-                first_action = card_data["data"][0]
-                last_action = card_data["data"][-1]
-                total_seconds = (last_action.date - first_action.date).total_seconds()
+            # ordered by date, so the rolling average goes along the time axis
+            for card_id, card_data in sorted(valid_cards.items(), key=lambda x: x[1][1]):
+                _, last_date, story_points, card_short_id, first_date = card_data
+                total_seconds = (last_date - first_date).total_seconds()
                 days = float(total_seconds) / 60 / 60 / 24
                 days_out = "{:.1f}".format(days)
-                date = last_action.date.strftime("%Y-%m-%d %H:%M")
+                date = last_date.strftime("%Y-%m-%d %H:%M")
                 self._chart_data.append({
                     "days": days_out,
                     "days_float": days,
-                    "id": card.id,
-                    "name": card.name,
-                    "size": last_action.story_points,
+                    "id": card_id,
+                    "name": card_names[card_id],
+                    "size": story_points,
                     "label": "Hours",
                     "date": date,
-                    "trello_card_short_id": last_action.event.card_short_id,
+                    "trello_card_short_id": card_short_id,
                 })
+            avg, lower, upper = self.rolling_average(self.days)
+            for d, a, l, u in zip(self._chart_data, avg, lower, upper):
+                d["rolling_avg"], d["rolling_lower"], d["rolling_upper"] = h_f(a), h_f(l), h_f(u)
         return self._chart_data
 
+    @property
+    def days(self):
+        """ numpy array of cycle times, in days, ordered by date """
+        return numpy.fromiter((x["days_float"] for x in self.chart_data), dtype=float,
+                              count=len(self.chart_data))
+
+    @classmethod
+    def rolling_average(cls, days, window=None):
+        """
+        average of last `window` cards at every card, and the average -/+ standard deviation
+
+        :param days: numpy array of cycle times
+        :param window: int, number of cards to average, defaults to ROLLING_WINDOW
+        :return: tuple of numpy arrays: average, lower band, upper band
+        """
+        window = window or cls.ROLLING_WINDOW
+        # rolling sums are differences of cumulative sums
+        sums = numpy.concatenate(([0.], numpy.cumsum(days)))
+        squares = numpy.concatenate(([0.], numpy.cumsum(days ** 2)))
+        end = numpy.arange(1, len(days) + 1)
+        # there are less than `window` cards at the beginning
+        beginning = numpy.maximum(end - window, 0)
+        count = end - beginning
+        avg = (sums[end] - sums[beginning]) / count
+        variance = (squares[end] - squares[beginning]) / count - avg ** 2
+        std = numpy.sqrt(numpy.maximum(variance, 0.))  # rounding errors
+        return avg, avg - std, avg + std
+
     def render_stats(self):
         """
-        stats for selected interval: min, max, avg
+        stats for selected interval: min, max, avg, percentiles and standard deviation
         lead/cycle/reaction time is not hardcoded - user has to pick the workflow
 
-        :return: string, raw html
+        :return: dict, context for the stats table
         """
         logger.debug("control chart stats")
-        if not self.chart_data:
-            return {"min": 0, "max": 0, "avg": 0}
+        days = self.days
+        if not days.size:
+            return dict.fromkeys(("min", "max", "avg", "p50", "p85", "p95", "std"), 0)
 
+        p50, p85, p95 = numpy.percentile(days, [50, 85, 95])
         return {
-            "min": h_f(min(self.chart_data, key=lambda x: x["days_float"])["days_float"]),
-            "max": h_f(max(self.chart_data, key=lambda x: x["days_float"])["days_float"]),
-            "avg": h_f(sum([x["days_float"] for x in self.chart_data]) / len(self.chart_data))
+            "min": h_f(days.min()),
+            "max": h_f(days.max()),
+            "avg": h_f(days.mean()),
+            "p50": h_f(p50),
+            "p85": h_f(p85),
+            "p95": h_f(p95),
+            "std": h_f(days.std()),
         }
@@ -52,11 +52,21 @@ var charting = {
     chart_data = {
       json: data["data"],
       keys: {
-        value: ["date", "days"],
+        value: ["date", "days", "rolling_avg", "rolling_lower", "rolling_upper"],
         x: 'date',
       },
       xFormat: constants.datetime_format,
       type: 'scatter',
+      types: {
+        rolling_avg: 'line',
+        rolling_lower: 'line',
+        rolling_upper: 'line',
+      },
+      names: {
+        rolling_avg: "Rolling average",
+        rolling_lower: "Rolling average - std",
+        rolling_upper: "Rolling average + std",
+      },
       onclick: on_point_click,
     };
 
@@ -275,13 +285,37 @@ var charting = {
   }
 };
 
+// the latest chart data for url and form, with their ETag
+var chart_data_cache = {};
+
+// post the form, server doesn't send the data again if they didn't change
+function post_chart_form(url, form_data, callback) {
+  var cache_key = url + "?" + form_data;
+  var cached = chart_data_cache[cache_key];
+  $.ajax({
+    type: "POST",
+    url: url,
+    data: form_data,
+    headers: cached ? {"If-None-Match": cached.etag} : {},
+    success: function(data, text_status, xhr) {
+      if (xhr.status === 304) {
+        data = cached.data;
+      } else if (xhr.getResponseHeader("ETag")) {
+        chart_data_cache[cache_key] = {etag: xhr.getResponseHeader("ETag"), data: data};
+      }
+      callback(data);
+    },
+    dataType: 'json' // I expect a JSON response
+  });
+}
+
 function load_chart(callback) {
   var errors = $(".form-errors");
   var row_div = errors.parent();
   if (!row_div.hasClass("hide")) {
     row_div.addClass("hide");
   }
-  $.post(
+  post_chart_form(
     GLOBAL.chart_data_url,
     $('#chart-settings').serialize(),
     function(data) {
@@ -292,8 +326,7 @@ function load_chart(callback) {
       } else {
         callback(data);
       }
-    },
-    'json' // I expect a JSON response
+    }
   );
 }
 
@@ -312,6 +345,9 @@ var controller = {
     });
   },
   index: function(){},
+  board_detail: function() {
+    poll_sync_status(false);
+  },
   chart_without_form: function() {
     $.get(
       GLOBAL.chart_data_url,
@@ -323,6 +359,31 @@ var controller = {
   }
 };
 
+// show progress of synchronization of the board, reload the page once it's done
+function poll_sync_status(was_active) {
+  $.get(
+    GLOBAL.sync_status_url,
+    function(job) {
+      var status = $("#sync-status");
+      if (job.active) {
+        var text = "Synchronizing";
+        if (job.total) {
+          text += ": " + Math.min(job.processed, job.total) + " of " + job.total + " actions";
+        }
+        status.text(text + "...");
+        setTimeout(function() { poll_sync_status(true); }, 2000);
+      } else if (was_active) {
+        location.reload();
+      } else if (job.state === "failed") {
+        status.text("Synchronization failed: " + job.error);
+      } else {
+        status.text("");
+      }
+    },
+    'json' // I expect a JSON response
+  );
+}
+
 // DOM is ready, let's start the show
 // mainly initialization stuff
 $(function() {
@@ -7,8 +7,8 @@ register = template.Library()
 
 def present_card(ca):
     t = '<a href="%s" class="trello-link" target="_blank">#%s</a>' % (
-        ca.event.card_url,
-        ca.event.card_short_id,
+        ca.card_url,
+        ca.card_short_id,
     )
     return t
 
@@ -0,0 +1,165 @@
+import datetime
+import json
+
+import pytest
+from flexmock import flexmock
+
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from trello_reporter.authentication.models import KeyVal, TrelloUser
+from trello_reporter.charting.cache import LRUBackend, ChartCache, chart_cache
+from trello_reporter.charting.listing import BoardListing
+from trello_reporter.charting.models import Board, Sprint, List, CardAction, Card, \
+    BoardUserMapping
+from trello_reporter.charting.views import ControlChartDataView
+from trello_reporter.harvesting.harvestor import Harvestor, ActionSpool
+from trello_reporter.harvesting.models import CardActionEvent
+
+
+def test_lru_backend():
+    backend = LRUBackend(2)
+    backend.set("a", 1)
+    backend.set("b", None)
+    assert backend.get("a") == (True, 1)
+    backend.set("c", 3)
+    # "b" is the least recently used one
+    assert backend.get("b") == (False, None)
+    assert backend.get("a") == (True, 1)
+    assert backend.get("c") == (True, 3)
+    assert len(backend) == 2
+
+    backend = LRUBackend(0)
+    backend.set("a", 1)
+    assert backend.get("a") == (False, None)
+
+
+def test_chart_cache_key():
+    b = Board(id=1, trello_id="1", data_version=3)
+    params = {"workflow": [["Next"], ["Complete"]], "beginning": timezone.now()}
+    key = ChartCache.get_key(b, "control", params)
+    assert key == ChartCache.get_key(b, "control", dict(params))
+    assert key != ChartCache.get_key(b, "burndown", params)
+    b.data_version = 4
+    assert key != ChartCache.get_key(b, "control", params)
+
+
+@pytest.mark.django_db
+def test_control_chart_data_is_cached(rf):
+    b = Board.get_or_create_board("1", name="B")
+    li = List.get_or_create_list("2", "Next")
+    c = Card.objects.create(trello_id="4", name="Card name")
+    ev = CardActionEvent.objects.create(data={}, processed_well=True)
+    CardAction.objects.create(trello_id="3", date=timezone.now(), action_type="createCard",
+                              card=c, event=ev, board=b, list=li)
+
+    def post():
+        request = rf.post(reverse("control-chart-data", args=(b.id, )), data={
+            'form-TOTAL_FORMS': '1',
+            'form-INITIAL_FORMS': '1',
+            'form-MAX_NUM_FORMS': '',
+            'form-0-workflow': 'Next',
+            'from_dt': (timezone.now() - datetime.timedelta(days=1)).strftime("%Y-%m-%d"),
+        })
+        response = ControlChartDataView().post(request, board_id=b.id)
+        assert response.status_code == 200
+        return json.loads(response.content)
+
+    stats = chart_cache.get_stats()
+    data = post()
+    assert "error" not in data
+    assert post() == data
+    assert chart_cache.get_stats()["misses"] == stats["misses"] + 1
+    assert chart_cache.get_stats()["hits"] == stats["hits"] + 1
+
+    # sprint changes bump data version as well
+    sprint = Sprint.objects.create(name="S 1", sprint_number=1, board=b)
+    assert post() == data
+    assert chart_cache.get_stats()["misses"] == stats["misses"] + 2
+    sprint.save()
+    Sprint.objects.get(id=sprint.id).save()
+    post()
+    assert chart_cache.get_stats()["misses"] == stats["misses"] + 2
+    sprint.end_dt = timezone.now()
+    sprint.save()
+    post()
+    assert chart_cache.get_stats()["misses"] == stats["misses"] + 3
+
+    # the action is stored already
+    data_version = Board.objects.get(id=b.id).data_version
+    flexmock(Sprint).should_receive("refresh").once()
+    with ActionSpool() as spool:
+        b.load_actions("token", spool, [{"id": "3"}])
+    assert Board.objects.get(id=b.id).data_version == data_version
+
+    b.bump_data_version()
+    assert b.data_version == Board.objects.get(id=b.id).data_version
+    post()
+    assert chart_cache.get_stats()["misses"] == stats["misses"] + 4
+
+
+@pytest.mark.django_db
+def test_board_settings_cache():
+    b = Board.get_or_create_board("1", name="B")
+    kv = KeyVal.objects.sprint_commitment_columns(b)
+    assert kv.board_id == b.id
+    assert KeyVal.objects.for_board(b.id).for_key(KeyVal.SPRINT_COMMITMENT_COLS).get() == kv
+
+    # changes of returned settings don't leak to the cache
+    kv.value["columns"].append("Something")
+    assert "Something" not in KeyVal.objects.sprint_commitment_columns(b).value["columns"]
+
+    # but saving them does invalidate it
+    kv.save()
+    assert "Something" in KeyVal.objects.sprint_commitment_columns(b).value["columns"]
+
+
+@pytest.mark.django_db
+def test_legacy_settings_are_backfilled():
+    b = Board.get_or_create_board("1", name="B")
+    kv = KeyVal.objects.create(key=KeyVal.BOARD_MESSAGES,
+                               value={"board_id": b.id, "user_id": None, "messages": ["m"]})
+    KeyVal.objects.filter(id=kv.id).update(board_id=None)
+
+    assert KeyVal.objects.board_messages(b).value["messages"] == ["m"]
+    assert KeyVal.objects.get(id=kv.id).board_id == b.id
+    assert KeyVal.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_sync_boards():
+    user = TrelloUser.get_or_create("u" * 24, "user")
+    boards_json = [{"id": "a" * 24, "name": "A"}, {"id": "b" * 24, "name": "B"}]
+    boards = Board.objects.sync_boards(user, boards_json)
+    assert [b.name for b in boards] == ["A", "B"]
+    assert BoardUserMapping.objects.filter(user=user).count() == 2
+
+    with CaptureQueriesContext(connection) as queries:
+        assert Board.objects.sync_boards(user, boards_json) == boards
+    assert all(q["sql"].startswith("SELECT") for q in queries.captured_queries)
+
+    boards_json[1]["name"] = "C"
+    boards_json.append({"id": "c" * 24, "name": "D"})
+    boards = Board.objects.sync_boards(user, boards_json)
+    stored = Board.objects.filter(id__in=[b.id for b in boards]).order_by("id")
+    assert [b.name for b in stored] == ["A", "C", "D"]
+    assert BoardUserMapping.objects.filter(user=user).count() == 3
+
+
+@pytest.mark.django_db
+def test_board_listing():
+    user = TrelloUser.get_or_create("u" * 24, "user")
+    boards_json = [{"id": "a" * 24, "name": "A"}]
+    flexmock(Harvestor).should_receive("list_boards").and_return(boards_json).once()
+    listing = BoardListing(ttl=60)
+    boards = listing.get(user, "token")
+    assert [b.name for b in boards] == ["A"]
+    # fresh: trello is not asked again
+    assert listing.get(user, "token") == boards
+
+    # stale: the listing is used and refreshed in background
+    listing.ttl = 0
+    flexmock(listing).should_receive("refresh_in_background").with_args(user, "token").once()
+    assert listing.get(user, "token") == boards
@@ -0,0 +1,116 @@
+import datetime
+import json
+
+import pytest
+import requests
+from flexmock import flexmock
+
+from django.core.urlresolvers import reverse
+from django.db import DatabaseError
+from django.utils import timezone
+
+from trello_reporter.authentication.models import TrelloUser
+from trello_reporter.charting import jobs
+from trello_reporter.charting.jobs import SyncQueue, error_message
+from trello_reporter.charting.models import Board, SyncJob
+from trello_reporter.charting.views import api_sync_status
+
+
+@pytest.mark.django_db
+def test_sync_jobs_are_coalesced():
+    b = Board.get_or_create_board("1", name="B")
+    user = TrelloUser.get_or_create("u" * 24, "user")
+    queue = SyncQueue(workers=0)
+
+    job = queue.enqueue(b, user, "token")
+    assert job.state == SyncJob.QUEUED
+    assert queue.enqueue(b, user, "token") == job
+
+    # queued by a different process which is gone
+    queue.tokens.clear()
+    assert queue.enqueue(b, user, "token") == job
+    SyncJob.objects.filter(id=job.id).update(
+        updated=timezone.now() - datetime.timedelta(days=1))
+    new_job = queue.enqueue(b, user, "token")
+    assert new_job != job
+    assert SyncJob.objects.get(id=job.id).state == SyncJob.FAILED
+
+
+@pytest.mark.django_db
+def test_sync_job_is_processed(rf):
+    b = Board.get_or_create_board("1", name="B")
+    queue = SyncQueue(workers=0)
+    job = queue.enqueue(b, None, "token")
+
+    def ensure_actions(token, progress=None):
+        assert token == "token"
+        progress(5, 10)
+        assert SyncJob.objects.get(id=job.id).state == SyncJob.RUNNING
+        progress(10, 10)
+
+    flexmock(Board).should_receive("ensure_actions").replace_with(ensure_actions).once()
+    assert queue.claim() == job.id
+    # nothing else to do
+    assert queue.claim() is None
+    queue.run(job.id)
+    assert not queue.tokens
+
+    request = rf.get(reverse("api-sync-status", args=(b.id, )))
+    status = json.loads(api_sync_status(request, board_id=b.id).content)
+    assert status["state"] == SyncJob.DONE
+    assert not status["active"]
+    assert (status["processed"], status["total"]) == (10, 10)
+
+    # jobs don't fail silently
+    job = queue.enqueue(b, None, "token")
+    flexmock(Board).should_receive("ensure_actions").and_raise(ValueError("bad token"))
+    assert queue.claim() == job.id
+    queue.run(job.id)
+    status = json.loads(api_sync_status(request, board_id=b.id).content)
+    assert status["state"] == SyncJob.FAILED
+    assert status["error"] == "ValueError: bad token"
+
+    # credentials are in query string of requests
+    url = "https://api.trello.com/1/boards/1/actions?limit=1000&key=secret-key&token=secret"
+    job = queue.enqueue(b, None, "secret")
+    response = requests.Response()
+    response.status_code, response.reason, response.url = 401, "Unauthorized", url
+    flexmock(Board).should_receive("ensure_actions").and_raise(requests.HTTPError(
+        "401 Client Error: Unauthorized for url: %s" % url, response=response))
+    assert queue.claim() == job.id
+    queue.run(job.id)
+    status = json.loads(api_sync_status(request, board_id=b.id).content)
+    assert status["error"] == "HTTPError: 401 Unauthorized"
+
+    for ex in (requests.ConnectionError("Max retries exceeded with url: %s" % url),
+               ValueError("can't parse 'key=secret-key&token=secret'")):
+        assert "secret" not in error_message(ex)
+
+
+@pytest.mark.django_db
+def test_sync_workers_survive_errors(monkeypatch):
+    b = Board.get_or_create_board("1", name="B")
+    queue = SyncQueue(workers=0)
+    job = queue.enqueue(b, None, "token")
+    flexmock(SyncJob.objects).should_receive("select_related").and_raise(
+        DatabaseError("db is gone"))
+    # the test runs in a transaction
+    monkeypatch.setattr(jobs, "close_old_connections", lambda: None)
+    queue.process_next()
+    assert SyncJob.objects.get(id=job.id).state == SyncJob.FAILED
+    assert not queue.tokens
+    # the board can be synced again
+    assert queue.enqueue(b, None, "token") != job
+
+    # dead workers are replaced
+    queue.workers_count = 2
+    monkeypatch.setattr(queue, "_work", lambda: None)
+    with queue.lock:
+        queue._ensure_workers()
+    dead = list(queue.workers)
+    for t in dead:
+        t.join()
+    with queue.lock:
+        queue._ensure_workers()
+    assert len(queue.workers) == 2
+    assert not set(queue.workers) & set(dead)
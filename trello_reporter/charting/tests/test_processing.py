@@ -1,17 +1,27 @@
 from __future__ import unicode_literals
 
+import datetime
 import json
 
 import pytest
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.utils.dateparse import parse_datetime
 
-from trello_reporter.charting.models import CardAction, Board, ListStat
+from trello_reporter.charting.ingestion import Ingestor
+from trello_reporter.charting.processing import ControlChart, ChartExporter
+from trello_reporter.charting.timeline import BoardTimeline
+from trello_reporter.charting.models import CardAction, Board, ListStat, List, BoardList, \
+    CardState, Sprint
 from data import faulty_move_to_board
 from trello_reporter.charting.tests.data import undetected_name_change
+from trello_reporter.harvesting.harvestor import ActionSpool
+from trello_reporter.harvesting.fake_trello import TrelloStandIn, StandInData, generate_board
 from trello_reporter.harvesting.models import CardActionEvent
 
 
 @pytest.mark.django_db
-def test_card_actions_creation():
+def test_card_actions_stats():
     b = Board(trello_id="5277b65546e5ca917f00939d", name="board name")
     b.save()
     actions = json.loads(faulty_move_to_board)
@@ -87,3 +97,351 @@ def test_card_actions_creation():
     events = CardActionEvent.objects.all()
     assert events[0].card_name == "Sprint 12"
     assert events[1].card_name == "Sprint 13"
+
+
+@pytest.mark.django_db
+def test_card_actions_creation_in_chunks():
+    b = Board(trello_id="5277b65546e5ca917f00939d", name="board name")
+    b.save()
+    actions = json.loads(faulty_move_to_board)
+    # running totals have to be carried over from previous chunks
+    Ingestor(b, chunk_size=3).ingest(actions)
+
+    lss = ListStat.objects.all().order_by("card_action__date", "id").select_related("list")
+    assert [(x.list.name, x.diff, x.cards_rt, x.story_points_rt) for x in lss] == [
+        ("Next", 1, 1, 0),
+        ("Next", 0, 1, 3),
+        ("Next", 0, 1, 5),
+        ("Next", -1, 0, 0),
+        ("New", 1, 1, 5),
+        ("New", 0, 1, 0),
+        ("New", -1, 0, 0),
+        ("Backlog", 1, 1, 0),
+        ("Backlog", -1, 0, 0),
+        ("Next", 1, 1, 0),
+        ("Next", -1, 0, 0),
+    ]
+    assert CardActionEvent.objects.count() == len(actions)
+
+
+@pytest.mark.django_db
+def test_list_stat_accumulator_continues_totals():
+    b = Board(trello_id="5277b65546e5ca917f00939d", name="board name")
+    b.save()
+    actions = json.loads(faulty_move_to_board)
+    Ingestor(b).ingest(actions[:5])
+    # a new sync has to pick up the totals from database
+    Ingestor(b).ingest(actions[5:])
+
+    lss = ListStat.objects.all().order_by("card_action__date", "id").select_related("list")
+    assert [(x.list.name, x.cards_rt, x.story_points_rt) for x in lss][-4:] == [
+        ("Backlog", 1, 0),
+        ("Backlog", 0, 0),
+        ("Next", 1, 0),
+        ("Next", 0, 0),
+    ]
+
+
+@pytest.mark.django_db
+def test_stored_actions_are_skipped():
+    b = Board(trello_id="5277b65546e5ca917f00939d", name="board name")
+    b.save()
+    actions = json.loads(faulty_move_to_board)
+    Ingestor(b).ingest(actions[:5])
+    stats = list(ListStat.objects.values_list("list", "cards_rt", "story_points_rt")
+                 .order_by("id"))
+    # overlapping fetch, duplicates within the response
+    Ingestor(b).ingest(actions[3:6] + actions[3:6])
+    Ingestor(b).ingest(actions)
+
+    assert CardActionEvent.objects.count() == len(actions)
+    assert CardActionEvent.objects.filter(trello_id=actions[4]["id"]).count() == 1
+    lss = list(ListStat.objects.values_list("list", "cards_rt", "story_points_rt")
+               .order_by("id"))
+    assert lss[:len(stats)] == stats
+    assert len(lss) == ListStat.objects.count() == 11
+
+
+@pytest.mark.django_db
+def test_backfill_card_actions():
+    b = Board(trello_id="5277b65546e5ca917f00939d", name="board name")
+    b.save()
+    actions = json.loads(faulty_move_to_board)
+    Ingestor(b).ingest(actions)
+    fields = ["card_short_id", "list_before_trello_id", "list_before_name",
+              "list_after_trello_id", "list_after_name", "is_rename", "card_closed"]
+    expected = list(CardAction.objects.order_by("id").values_list(*fields))
+    assert any(x[0] for x in expected)
+    assert any(x[3] for x in expected)
+    assert any(x[5] for x in expected)
+
+    CardAction.objects.update(card_short_id=None, list_before_trello_id=None,
+                              list_before_name=None, list_after_trello_id=None,
+                              list_after_name=None, is_rename=False, card_closed=False)
+    call_command("backfill_card_actions", batch_size=2)
+    assert list(CardAction.objects.order_by("id").values_list(*fields)) == expected
+
+
+@pytest.mark.django_db
+def test_board_list_registry():
+    b = Board(trello_id="5277b65546e5ca917f00939d", name="board name")
+    b.save()
+    actions = json.loads(faulty_move_to_board)
+    Ingestor(b, chunk_size=3).ingest(actions)
+
+    def registry():
+        return sorted(BoardList.objects.for_board(b).values_list("list", "name", "last_seen"))
+
+    maintained = registry()
+    # there are two lists named "Next"
+    assert sorted(x[1] for x in maintained) == ["Backlog", "New", "Next", "Next"]
+    BoardList.objects.rebuild(b)
+    assert registry() == maintained
+
+    # boards processed before registry existed
+    BoardList.objects.all().delete()
+    assert List.objects.get_all_listnames_for_board(b) == ["Backlog", "New", "Next"]
+    assert registry() == maintained
+    latest_next = BoardList.objects.filter(board=b, name="Next").latest().list
+    assert list(List.objects.filter_lists_for_board(b, f=["Next"])) == [latest_next]
+    assert sorted(li.name for li in List.objects.lists_for_board_match_regex(b, r"^ne")) == \
+        ["New", "Next"]
+
+
+@pytest.mark.django_db
+def test_card_state():
+    b = Board(trello_id="5277b65546e5ca917f00939d", name="board name")
+    b.save()
+    actions = json.loads(faulty_move_to_board)
+    Ingestor(b, chunk_size=3).ingest(actions[:5])
+    Ingestor(b, chunk_size=3).ingest(actions[5:])
+
+    def state():
+        return sorted(CardState.objects.for_board(b).values_list(
+            "card", "card_action", "list", "story_points", "is_archived", "is_deleted"))
+
+    maintained = state()
+    time_machine = CardAction.objects.for_board(b).distinct_cards()
+    assert [x[1] for x in maintained] == sorted(x.id for x in time_machine)
+    CardState.objects.rebuild(b)
+    assert state() == maintained
+
+    CardState.objects.all().delete()
+    present = CardAction.objects.get_card_actions_on_board_in(b)
+    assert sorted(x.id for x in present) == [x[1] for x in maintained]
+    assert state() == maintained
+
+
+@pytest.mark.django_db
+def test_stats_for_list_names_at():
+    b = Board(trello_id="5277b65546e5ca917f00939d", name="board name")
+    b.save()
+    Ingestor(b).ingest(json.loads(faulty_move_to_board))
+    list_names = ["New", "Next", "Backlog", "Complete"]
+    first = CardAction.objects.for_board(b).earliest()
+    last = CardAction.objects.for_board(b).latest()
+    step = (last.date - first.date) / 20
+    dates = [first.date + step * i for i in range(22)] + [last.date]
+
+    stats_at = ListStat.objects.stats_for_list_names_at(b, list_names, dates)
+    assert len(stats_at) == len(dates)
+    for d, stats in zip(dates, stats_at):
+        expected = ListStat.objects.stats_for_list_names_before(b, list_names, d)
+        assert stats == [(x.list.name, x.cards_rt, x.story_points_rt) for x in expected]
+    assert any(stats_at)
+
+
+@pytest.mark.django_db
+def test_board_timeline():
+    b = Board(trello_id="5277b65546e5ca917f00939d", name="board name")
+    b.save()
+    Ingestor(b).ingest(json.loads(faulty_move_to_board))
+    list_names = ["New", "Next", "Backlog", "Complete"]
+    first = CardAction.objects.for_board(b).earliest()
+    last = CardAction.objects.for_board(b).latest()
+    step = (last.date - first.date) / 20
+    dates = [first.date + step * i for i in range(22)] + [first.date, last.date]
+
+    timeline = BoardTimeline.for_board(b)
+    assert timeline.stats_for_list_names_at(list_names, dates) == \
+        ListStat.objects.stats_for_list_names_at(b, list_names, dates)
+
+    for li in List.objects.for_board(b):
+        history = timeline.list_history_in_range(li, first.date, last.date - step)
+        expected = ListStat.objects.for_list_in_range(li, first.date, last.date - step)
+        assert CardActionEvent._meta.db_table not in str(expected.query)
+        assert sorted(history) == \
+            sorted((x.card_action.date, x.cards_rt, x.story_points_rt) for x in expected)
+        assert [x[0] for x in history] == sorted([x[0] for x in history], reverse=True)
+
+    assert BoardTimeline.for_board(b) is timeline
+    BoardTimeline.invalidate(b)
+    assert BoardTimeline.for_board(b) is not timeline
+
+
+@pytest.mark.django_db
+def test_board_timelines_of_shared_lists(settings, monkeypatch):
+    settings.CHART_TIMELINE_SIZE = 1
+    monkeypatch.setattr(BoardTimeline, "_timelines", None)
+    boards = [Board.objects.create(trello_id=x * 24, name=x) for x in "ab"]
+    for b in boards:
+        actions = json.loads(faulty_move_to_board)
+        # the same lists, but different actions
+        for action in actions:
+            action["id"] = b.trello_id[0] + action["id"][1:]
+        Ingestor(b).ingest(actions)
+
+    timeline = BoardTimeline.for_board(boards[0])
+    assert BoardTimeline.for_board(boards[0]) is timeline
+    BoardTimeline.for_board(boards[1])
+    assert len(BoardTimeline._timelines) == 1
+    assert BoardTimeline.for_board(boards[0]) is not timeline
+
+    first = CardAction.objects.earliest().date
+    last = CardAction.objects.latest().date
+    for li in List.objects.filter(board_lists__board=boards[1]):
+        settings.CHART_TIMELINE = False
+        expected = ChartExporter.list_history_chart_c3(li, first, last)
+        settings.CHART_TIMELINE = True
+        assert ChartExporter.list_history_chart_c3(li, first, last) == expected
+        assert len(expected) == 2 * ListStat.objects.for_board(boards[0]).for_list(li).count()
+
+
+@pytest.mark.django_db
+def test_latest_card_actions_in_windows():
+    b = Board(trello_id="5277b65546e5ca917f00939d", name="board name")
+    b.save()
+    Ingestor(b).ingest(json.loads(faulty_move_to_board))
+    first = CardAction.objects.for_board(b).earliest()
+    last = CardAction.objects.for_board(b).latest()
+    delta = (last.date - first.date) / 10
+    dates = [first.date + delta * i for i in range(12)]
+
+    windows = CardAction.objects.latest_card_actions_in_windows(b, dates, delta)
+    for d, window in zip(dates, windows):
+        list_names = ["New", "Next", "Backlog"]
+        expected = CardAction.objects.card_actions_on_list_names_in_range(
+            b, list_names, d - delta, d)
+        assert sorted(x.id for x in window if x.list and x.list.name in list_names) == \
+            sorted(x.id for x in expected)
+    assert any(windows)
+
+
+@pytest.mark.django_db
+def test_story_points_of_sprints():
+    b = Board(trello_id="5277b65546e5ca917f00939d", name="board name")
+    b.save()
+    Ingestor(b).ingest(json.loads(faulty_move_to_board))
+    dates = sorted(CardAction.objects.for_board(b).values_list("date", flat=True))
+    lists = list(List.objects.order_by("id"))
+    sprints = [
+        Sprint.objects.create(board=b, sprint_number=i, start_dt=d, end_dt=d,
+                              completed_list=li)
+        for i, (d, li) in enumerate(zip(dates[::2], lists + [None]))
+    ]
+    commitment_cols = ["Next", "New"]
+
+    story_points = Sprint.objects.story_points_of_sprints(sprints, commitment_cols)
+    assert story_points == {
+        s.id: (s.story_points_committed(commitment_cols), s.story_points_done) for s in sprints
+    }
+    assert any(x[0] for x in story_points.values())
+
+
+@pytest.mark.django_db
+def test_control_chart_lead_time():
+    board_json = generate_board(actions_count=500)
+    b = Board.get_or_create_board(board_json["id"], name=board_json["name"])
+    actions = sorted(board_json["actions"], key=lambda x: x["date"])
+    Ingestor(b).ingest(actions)
+    dates = [parse_datetime(a["date"]) for a in actions]
+
+    # card id -> [date of creation, date of completion]
+    expected = {}
+    for a, date in zip(actions, dates):
+        card = a["data"]["card"]
+        if a["type"] == "createCard":
+            expected[card["idShort"]] = [date, None]
+        elif a["data"].get("listAfter", {}).get("name", None) == "Complete":
+            expected[card["idShort"]][1] = date
+    expected = {k: (v[1] - v[0]).total_seconds() / 60 / 60 / 24
+                for k, v in expected.items() if v[1]}
+
+    chart_data = ControlChart(b, [["New"], ["Complete"]], dates[0],
+                              dates[-1]).chart_data
+    assert {x["trello_card_short_id"]: x["days_float"] for x in chart_data} == expected
+    assert expected
+
+
+def test_control_chart_stats():
+    days = [float(x) for x in [5, 1, 3, 2, 4, 10, 6, 8, 7, 9]]
+    chart = ControlChart(None, [["New"], ["Complete"]], None, None)
+    chart._chart_data = [{"days_float": x} for x in days]
+    assert chart.render_stats() == {
+        "min": "1.0", "max": "10.0", "avg": "5.5", "p50": "5.5", "p85": "8.6", "p95": "9.5",
+        "std": "2.9",
+    }
+
+    avg, lower, upper = ControlChart.rolling_average(chart.days, window=3)
+    for i in range(len(days)):
+        window = days[max(0, i - 2):i + 1]
+        mean = sum(window) / len(window)
+        std = (sum((x - mean) ** 2 for x in window) / len(window)) ** 0.5
+        assert abs(avg[i] - mean) < 1e-9
+        assert abs(lower[i] - (mean - std)) < 1e-9
+        assert abs(upper[i] - (mean + std)) < 1e-9
+
+    chart._chart_data = []
+    assert chart.render_stats()["p85"] == 0
+
+
+@pytest.mark.django_db
+def test_ensure_actions_against_standin(settings):
+    board_json = generate_board(actions_count=1500)
+    with TrelloStandIn(data=StandInData(boards=[board_json])) as standin:
+        settings.TRELLO_API_URL = standin.url
+        b = Board.get_or_create_board(board_json["id"], name=board_json["name"])
+        b.ensure_actions("123")
+
+    assert CardActionEvent.objects.count() == 1500
+    expected = {}
+    for c in board_json["cards"]:
+        if not c["closed"]:
+            points = CardAction.get_story_points(c["name"])
+            cards, sp = expected.get(c["idList"], (0, 0))
+            expected[c["idList"]] = (cards + 1, sp + int(points))
+    lists = List.objects.filter(trello_id__in=[x["id"] for x in board_json["lists"]])
+    stats = ListStat.objects.latest_for_lists([li.id for li in lists]).select_related("list")
+    assert {x.list.trello_id: (x.cards_rt, x.story_points_rt) for x in stats
+            if x.cards_rt} == expected
+
+
+@pytest.mark.django_db
+def test_sync_boards_against_standin(settings, monkeypatch):
+    boards_json = [
+        generate_board(board_id="a" * 24, actions_count=200),
+        generate_board(board_id="b" * 24, actions_count=300, start=datetime.datetime(2016, 6, 1)),
+    ]
+    spools = []
+    spool_init = ActionSpool.__init__
+
+    def track_spool(spool):
+        spool_init(spool)
+        spools.append(spool)
+
+    monkeypatch.setattr(ActionSpool, "__init__", track_spool)
+    with TrelloStandIn(data=StandInData(boards=boards_json)) as standin:
+        settings.TRELLO_API_URL = standin.url
+        for board_json in boards_json:
+            Board.get_or_create_board(board_json["id"], name=board_json["name"])
+        # not on trello
+        Board.get_or_create_board("c" * 24, name="C")
+        with pytest.raises(CommandError) as ex:
+            call_command("sync_boards", "--all", token="123", concurrency=3)
+
+    assert "C" in str(ex.value)
+    assert CardActionEvent.objects.count() == 500
+    for board_json in boards_json:
+        assert Board.objects.get(trello_id=board_json["id"]).card_actions.exists()
+    assert len(spools) == 3
+    assert all(spool.f.closed for spool in spools)
@@ -4,7 +4,8 @@ from django.core.urlresolvers import reverse
 from django.utils import timezone
 
 from trello_reporter.charting.models import Board, Sprint, List, CardAction, Card
-from trello_reporter.charting.views import ControlChartDataView, ControlChartView
+from trello_reporter.charting.views import ControlChartDataView, ControlChartView, \
+    VelocityChartDataView
 from trello_reporter.harvesting.models import CardActionEvent
 
 
@@ -44,3 +45,32 @@ def test_control_chart_data(rf):
     c = ControlChartDataView()
     response = c.post(request, board_id=b.id)
     assert response.status_code == 200
+
+
+@pytest.mark.django_db
+def test_velocity_chart_data_etag(rf):
+    b = Board.get_or_create_board("1", name="B")
+    url = reverse("velocity-chart-data", args=(b.id, ))
+
+    response = VelocityChartDataView().post(rf.post(url, data={"last_n": "3"}), board_id=b.id)
+    assert response.status_code == 200
+    etag = response["ETag"]
+    assert "no-cache" in response["Cache-Control"]
+
+    request = rf.post(url, data={"last_n": "3"}, HTTP_IF_NONE_MATCH=etag)
+    response = VelocityChartDataView().post(request, board_id=b.id)
+    assert response.status_code == 304
+    assert response["ETag"] == etag
+
+    request = rf.post(url, data={"last_n": "4"}, HTTP_IF_NONE_MATCH=etag)
+    response = VelocityChartDataView().post(request, board_id=b.id)
+    assert response.status_code == 200
+    assert response["ETag"] != etag
+
+    # sprints are part of the data
+    Sprint.objects.create(name="S 1", sprint_number=1, board=b, start_dt=timezone.now(),
+                          end_dt=timezone.now())
+    request = rf.post(url, data={"last_n": "3"}, HTTP_IF_NONE_MATCH=etag)
+    response = VelocityChartDataView().post(request, board_id=b.id)
+    assert response.status_code == 200
+    assert response["ETag"] != etag
@@ -0,0 +1,162 @@
+"""
+In-memory history of lists on a board
+
+Charts keep asking what was the state of a list at a given time. Instead of asking database
+over and over, the whole ListStat history of a board is loaded once into sorted numpy arrays
+and the questions are answered with a binary search (numpy.searchsorted).
+
+It's optional, see settings.CHART_TIMELINE. Timelines live in the memory of the process and
+are loaded again when Board.data_version changes; only settings.CHART_TIMELINE_SIZE of the
+recently used ones are kept.
+"""
+
+from __future__ import unicode_literals
+
+import datetime
+import logging
+import threading
+
+import numpy
+from django.conf import settings
+from django.utils import timezone
+
+from trello_reporter.charting.cache import LRUBackend
+from trello_reporter.charting.models import ListStat
+
+
+logger = logging.getLogger(__name__)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_microseconds(dt):
+    """ datetime -> int, microseconds since epoch; int64 is precise, unlike float """
+    td = dt - EPOCH
+    return (td.days * 86400 + td.seconds) * 1000000 + td.microseconds
+
+
+def from_microseconds(us):
+    return EPOCH + datetime.timedelta(microseconds=int(us))
+
+
+def nullable(value):
+    """ running totals can be NULL, these are stored as NaN """
+    if numpy.isnan(value):
+        return None
+    return int(value)
+
+
+class ListHistory(object):
+    """ running totals of a list (or of lists with the same name), ordered by date """
+    __slots__ = ("timestamps", "cards_rt", "story_points_rt")
+
+    def __init__(self, timestamps, cards_rt, story_points_rt):
+        self.timestamps = numpy.array(timestamps, dtype=numpy.int64)
+        self.cards_rt = numpy.array(cards_rt, dtype=float)
+        self.story_points_rt = numpy.array(story_points_rt, dtype=float)
+
+    def indexes_before(self, timestamps):
+        """
+        :param timestamps: numpy array of microseconds
+        :return: numpy array, index of the latest stat before every timestamp, -1 = none
+        """
+        return numpy.searchsorted(self.timestamps, timestamps, side="left") - 1
+
+
+class BoardTimeline(object):
+    """ ListStat history of a single board """
+
+    # board id -> BoardTimeline, LRUBackend created on first use
+    _timelines = None
+    _lock = threading.Lock()
+
+    def __init__(self, board):
+        self.board_id = board.id
+        self.data_version = board.data_version
+        # list id -> ListHistory
+        self.lists = {}
+        # list name -> ListHistory, merged histories of lists with the same name
+        self.names = {}
+        self._load()
+
+    def __unicode__(self):
+        return "timeline of board %s (%d lists)" % (self.board_id, len(self.lists))
+
+    def _load(self):
+        stats = ListStat.objects \
+            .filter(card_action__board_id=self.board_id) \
+            .order_by("card_action__date", "id") \
+            .values_list("list_id", "list__name", "card_action__date",
+                         "cards_rt", "story_points_rt")
+        by_list = {}
+        by_name = {}
+        for list_id, list_name, date, cards_rt, story_points_rt in stats.iterator():
+            row = (to_microseconds(date),
+                   numpy.nan if cards_rt is None else cards_rt,
+                   numpy.nan if story_points_rt is None else story_points_rt)
+            by_list.setdefault(list_id, []).append(row)
+            # stats are ordered, hence merged histories are ordered as well
+            by_name.setdefault(list_name, []).append(row)
+        for d, rows_dict in ((self.lists, by_list), (self.names, by_name)):
+            for key, rows in rows_dict.items():
+                d[key] = ListHistory(*zip(*rows))
+        logger.info("loaded %s", self)
+
+    @classmethod
+    def _registry(cls):
+        with cls._lock:
+            if cls._timelines is None:
+                cls._timelines = LRUBackend(settings.CHART_TIMELINE_SIZE)
+            return cls._timelines
+
+    @classmethod
+    def for_board(cls, board):
+        """ timeline of the board, loaded from database on first use """
+        found, timeline = cls._registry().get(board.id)
+        # data could have been changed by a different process
+        if not found or timeline.data_version != board.data_version:
+            timeline = cls(board)
+            cls._registry().set(board.id, timeline)
+        return timeline
+
+    @classmethod
+    def invalidate(cls, board):
+        """ stats of the board changed, load them again next time """
+        cls._registry().delete(board.id)
+
+    def stats_for_list_names_at(self, list_names, dates):
+        """
+        the same as ListStatManager.stats_for_list_names_at
+
+        :return: list with an item for every date: list of tuples
+                 (list name, cards_rt, story_points_rt)
+        """
+        response = [[] for _ in dates]
+        timestamps = numpy.fromiter((to_microseconds(d) for d in dates), dtype=numpy.int64,
+                                    count=len(dates))
+        for name in sorted(list_names):
+            history = self.names.get(name, None)
+            if history is None:
+                continue
+            indexes = history.indexes_before(timestamps)
+            for stats, idx in zip(response, indexes):
+                if idx >= 0:
+                    stats.append((name, nullable(history.cards_rt[idx]),
+                                  nullable(history.story_points_rt[idx])))
+        return response
+
+    def list_history_in_range(self, li, beginning, end):
+        """
+        running totals of the list in the range (inclusive), the latest first
+
+        :return: list of tuples (date, cards_rt, story_points_rt)
+        """
+        history = self.lists.get(li.id, None)
+        if history is None:
+            return []
+        start = numpy.searchsorted(history.timestamps, to_microseconds(beginning), side="left")
+        stop = numpy.searchsorted(history.timestamps, to_microseconds(end), side="right")
+        return [(from_microseconds(history.timestamps[idx]),
+                 nullable(history.cards_rt[idx]),
+                 nullable(history.story_points_rt[idx]))
+                for idx in range(stop - 1, start - 1, -1)]
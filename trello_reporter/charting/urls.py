@@ -43,6 +43,8 @@ urlpatterns = [
         name='show-burndown-chart'),
 
     url(r'^api/v0/card/(?P<card_id>[0-9]+)/$', views.api_get_card, name='api-get-card'),
+    url(r'^api/v0/board/(?P<board_id>[0-9]+)/sync/$', views.api_sync_status,
+        name='api-sync-status'),
     url(r'^api/v0/board/(?P<board_id>[0-9]+)/cumulative-flow/$',
         views.CumulativeFlowChartDataView.as_view(),
         name='cumulative-flow-chart-data'),
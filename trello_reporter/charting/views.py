@@ -1,24 +1,31 @@
 from __future__ import unicode_literals
 
 import datetime
+import hashlib
 import json
 import logging
 from urllib import urlencode
 
 from django.core.urlresolvers import reverse
-from django.http.response import JsonResponse, Http404
+from django.http.response import JsonResponse, Http404, HttpResponseNotModified
 from django.shortcuts import render, redirect
 from django.template import loader
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 from django.views.generic.base import TemplateView
 
 from trello_reporter.authentication.models import KeyVal
 from trello_reporter.charting import forms
+from trello_reporter.charting.cache import chart_cache
+from trello_reporter.charting.jobs import sync_queue
+from trello_reporter.charting.listing import board_listing
 from trello_reporter.charting.constants import CUMULATIVE_FLOW_INITIAL_WORKFLOW, COMPLETED_COLUMNS, \
     SELECTED_COLUMNS_DESCRIPTION, SPRINT_COMMITMENT_DESCRIPTION, DATA_SYNCHRONIZATION_DESCRIPTION, \
     SPRINT_CALCULATION_DESCRIPTION, BURNDOWN_CHART_DESCRIPTION, CONTROL_CHART_DESCRIPTION, \
     VELOCITY_CHART_DESCRIPTION, CUMULATIVE_FLOW_CHART_DESCRIPTION
-from trello_reporter.charting.models import Board, CardAction, List, Card, Sprint, ListStat
+from trello_reporter.charting.models import Board, CardAction, List, Card, Sprint, ListStat, \
+    SyncJob
 from trello_reporter.charting.processing import ChartExporter, ControlChart
 from trello_reporter.charting.templatetags.card import display_card
 from trello_reporter.harvesting.models import CardActionEvent
@@ -33,7 +40,7 @@ CONTROL_INITIAL_WORKFLOW = [["Next"], ["Complete"]]
 
 def index(request):
     logger.debug("display index")
-    boards = Board.list_boards(request.user, request.COOKIES["token"])
+    boards = board_listing.get(request.user, request.COOKIES["token"])
     return render(request, "index.html", {
         "boards": boards,
         "breadcrumbs": [Breadcrumbs.text("Boards")]
@@ -69,6 +76,18 @@ class BaseView(TemplateView):
     view_name = None  # for javascript
 
 
+def ticks_until_now(beginning, end, delta):
+    """
+    charts which reach the present get a new tick every delta, even when data don't change
+
+    :return: int, number of ticks until now, None if the chart doesn't reach the present
+    """
+    now = timezone.now()
+    if beginning is None or (end is not None and end <= now):
+        return None
+    return int((now - beginning).total_seconds() // delta.total_seconds())
+
+
 def humanize_form_errors(form_list=None, formsets=None):
     """ return html with errors in forms; should be piped into notification widget """
     texts = []
@@ -117,6 +136,29 @@ class ChartView(BaseView):
         context["form"] = self.form
         return context
 
+    def chart_data_response(self, request, board, params, compute):
+        """
+        respond with chart data, which are computed only if they are not cached
+
+        data are identified by an ETag, if the client has them already (If-None-Match), it
+        gets 304 Not Modified
+
+        :param params: json-like structure, everything the chart is computed from
+        :param compute: callable, returns content of the response
+        """
+        key = chart_cache.get_key(board, self.chart_name, params)
+        etag = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        if etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+            logger.debug("client has chart data already: %s", key)
+            response = HttpResponseNotModified()
+        else:
+            response = JsonResponse(
+                chart_cache.get_or_compute(board, self.chart_name, params, compute))
+        response["ETag"] = quote_etag(etag)
+        # always ask if the data changed
+        patch_cache_control(response, no_cache=True)
+        return response
+
     @staticmethod
     def respond_json_form_errors(form_list, formset=None):
         return JsonResponse({"error": "Form is not valid: " +
@@ -178,12 +220,14 @@ class ControlChartDataView(ControlChartBase):
             context["board"], formset.workflow, form.cleaned_data["beginning"],
             form.cleaned_data["end"])
 
-        data = chart.chart_data
-
-        html = loader.render_to_string("chunks/control_chart_table.html",
-                                       context=chart.render_stats())
+        def compute():
+            data = chart.chart_data
+            html = loader.render_to_string("chunks/control_chart_table.html",
+                                           context=chart.render_stats())
+            return {"data": data, "html": html}
 
-        return JsonResponse({"data": data, "html": html})
+        params = [formset.workflow, form.cleaned_data["beginning"], form.cleaned_data["end"]]
+        return self.chart_data_response(request, context["board"], params, compute)
 
 
 class BurndownChartBase(ChartView):
@@ -237,10 +281,8 @@ class BurndownChartDataView(BurndownChartBase):
         # so self.commitment_cols is set
         super(BurndownChartDataView, self).get_context_data(*args, **kwargs)
         sprint = Sprint.objects.get(id=sprint_id)
-        data = ChartExporter.burndown_chart_c3(
-            sprint.board, sprint.start_dt,
-            sprint.end_dt, self.commitment_cols)
-        return JsonResponse({"data": data})
+        return self.burndown_response(request, sprint.board, sprint.start_dt, sprint.end_dt,
+                                      self.commitment_cols)
 
     def post(self, request, board_id, *args, **kwargs):
         logger.debug("get data for burndown chart")
@@ -250,10 +292,15 @@ class BurndownChartDataView(BurndownChartBase):
 
         if not (form.is_valid() and com_form.is_valid()):
             return self.respond_json_form_errors(form_list=(form, com_form))
-        data = ChartExporter.burndown_chart_c3(
-            context["board"], form.cleaned_data["beginning"],
-            form.cleaned_data["end"], com_form.workflow)
-        return JsonResponse({"data": data})
+        return self.burndown_response(request, context["board"], form.cleaned_data["beginning"],
+                                      form.cleaned_data["end"], com_form.workflow)
+
+    def burndown_response(self, request, board, beginning, end, in_progress_list_names):
+        params = [beginning, end, in_progress_list_names,
+                  ticks_until_now(beginning, end, datetime.timedelta(days=1))]
+        return self.chart_data_response(request, board, params, lambda: {
+            "data": ChartExporter.burndown_chart_c3(board, beginning, end, in_progress_list_names)
+        })
 
 
 class CumulativeFlowChartBase(ChartView):
@@ -309,16 +356,24 @@ class CumulativeFlowChartDataView(CumulativeFlowChartBase):
         if not (form.is_valid() and formset.is_valid()):
             return self.respond_json_form_errors([form], formset=formset)
         order = formset.workflow
-        data = ChartExporter.cumulative_chart_c3(
-            context["board"],
-            order,
-            form.cleaned_data["beginning"], form.cleaned_data["end"],
-            form.cleaned_data["delta"],
-            form.cleaned_data["cards_or_sp"]
-        )
-        # c3 wants reversed order
-        return JsonResponse({"data": data, "order": list(reversed(order)),
-                             "all_lists": context["all_lists"]})
+        beginning, end = form.cleaned_data["beginning"], form.cleaned_data["end"]
+        delta = form.cleaned_data["delta"]
+        params = [order, beginning, end, delta, form.cleaned_data["cards_or_sp"],
+                  ticks_until_now(beginning, end, delta)]
+
+        def compute():
+            data = ChartExporter.cumulative_chart_c3(
+                context["board"],
+                order,
+                beginning, end,
+                delta,
+                form.cleaned_data["cards_or_sp"]
+            )
+            # c3 wants reversed order
+            return {"data": data, "order": list(reversed(order)),
+                    "all_lists": context["all_lists"]}
+
+        return self.chart_data_response(request, context["board"], params, compute)
 
 
 class VelocityChartBase(ChartView):
@@ -336,13 +391,18 @@ class VelocityChartBase(ChartView):
         context["board"] = board
         return context
 
-    def get_chart_data(self, context):
+    def get_chart_params(self, context):
+        """ :return: tuple, (number of latest sprints, commitment columns) """
         if self.form.is_bound:
             last_n = self.form.cleaned_data["last_n"]
         else:
             last_n = self.form.fields["last_n"].initial
-        sprints = Sprint.objects.for_board_last_n(context["board"], last_n)
         cc = KeyVal.objects.sprint_commitment_columns(context["board"]).value["columns"]
+        return last_n, cc
+
+    def get_chart_data(self, context):
+        last_n, cc = self.get_chart_params(context)
+        sprints = Sprint.objects.for_board_last_n(context["board"], last_n)
         return ChartExporter.velocity_chart_c3(sprints, cc)
 
 
@@ -373,8 +433,9 @@ class VelocityChartDataView(VelocityChartBase):
         if not form.is_valid():
             return self.respond_json_form_errors([form])
 
-        data = self.get_chart_data(context)
-        return JsonResponse({"data": data})
+        return self.chart_data_response(request, context["board"],
+                                        self.get_chart_params(context),
+                                        lambda: {"data": self.get_chart_data(context)})
 
 
 class ListDetailBase(ChartView):
@@ -406,7 +467,8 @@ class ListDetailView(ListDetailBase):
         context["breadcrumbs"] = Breadcrumbs.board_detail(context["list"].latest_action.board) + \
             [Breadcrumbs.text("Column \"%s\"" % context["list"].name)]
         context["list_stats"] = ListStat.objects.for_list_in_range(
-            context["list"], self.initial_form_data["from_dt"], self.initial_form_data["to_dt"])
+            context["list"], self.initial_form_data["from_dt"], self.initial_form_data["to_dt"]) \
+            .select_related("card_action__card")
         return context
 
 
@@ -482,6 +544,7 @@ def board_detail(request, board_id):
         "sprint_commitment_description": SPRINT_COMMITMENT_DESCRIPTION,
         "data_synchronization_description": DATA_SYNCHRONIZATION_DESCRIPTION,
         "sprint_calculation_description": SPRINT_CALCULATION_DESCRIPTION,
+        "sync_status_url": reverse("api-sync-status", args=(board_id, )),
     }
     return render(request, "board_detail.html", context)
 
@@ -489,7 +552,8 @@ def board_detail(request, board_id):
 def board_refresh(request, board_id):
     board = Board.objects.by_id(board_id)
     logger.debug("refresh board %s", board)
-    board.ensure_actions(request.COOKIES["token"])
+    # synced in background, board detail shows the progress
+    sync_queue.enqueue(board, request.user, request.COOKIES["token"])
     return redirect('board-detail', board_id=board_id)
 
 
@@ -611,6 +675,27 @@ def stalled_cards(request, list_id):
 # API
 
 
+def api_sync_status(request, board_id):
+    """ state of the latest synchronization of the board """
+    board = Board.objects.by_id(board_id)
+    try:
+        job = SyncJob.objects.for_board(board).latest()
+    except SyncJob.DoesNotExist:
+        return JsonResponse({"state": None})
+
+    response = {
+        "id": job.id,
+        "state": job.state,
+        "active": job.is_active,
+        "processed": job.processed,
+        "total": job.total,
+        "error": job.error,
+        "created": job.created,
+        "finished": job.finished,
+    }
+    return JsonResponse(response)
+
+
 def api_get_card(request, card_id):
     card = Card.objects.get(id=card_id)
     logger.debug("api: get card %s", card)
@@ -0,0 +1,452 @@
+"""
+Local stand-in of trello API, for tests and benchmarks of harvesting without network
+
+It serves the endpoints Harvestor uses:
+
+ * boards generated synthetically or loaded from a file; actions are paginated the same way
+   trello does it (newest first, limit, before, since)
+ * replay of a session recorded from real trello
+
+and it can also record: proxy requests to real trello and store the responses.
+
+Point the app to it via TRELLO_API_URL, e.g.:
+
+    $ python -m trello_reporter.harvesting.fake_trello --port 8001 --synthetic 20000
+    $ TRELLO_API_URL=http://127.0.0.1:8001 ...
+"""
+
+import argparse
+import calendar
+import datetime
+import json
+import logging
+import random
+import threading
+import time
+import urllib
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import requests
+
+# dateparse doesn't need configured settings
+from django.utils.dateparse import parse_datetime
+
+
+logger = logging.getLogger(__name__)
+
+
+# query parameters which are not part of a recorded request
+CREDENTIAL_PARAMS = ("key", "token")
+
+DEFAULT_LISTS = ["New", "Backlog", "Next", "In Progress", "Complete"]
+
+
+def format_date(dt):
+    """ the same format trello uses: 2016-07-12T11:32:14.696Z """
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.") + "%03dZ" % (dt.microsecond // 1000)
+
+
+def object_id(dt, counter):
+    """ trello ids start with the creation time of the object, just like mongo's ObjectId """
+    return "%08x%016x" % (calendar.timegm(dt.utctimetuple()), counter)
+
+
+def object_timestamp(trello_id):
+    """ :return: int, unix time when the object was created """
+    return int(trello_id[:8], 16)
+
+
+def date_param(params, name):
+    """
+    :return: datetime or None if the parameter is not set
+    :raises ValueError: the value is not a date, trello responds with 400 then
+    """
+    if name not in params:
+        return None
+    value = parse_datetime(params[name])
+    if value is None:
+        raise ValueError("invalid value for %s" % name)
+    return value
+
+
+def request_key(path, query):
+    """ identify request for record/replay: path and sorted query without credentials """
+    params = sorted((k, v) for k, v in urlparse.parse_qsl(query, keep_blank_values=True)
+                    if k not in CREDENTIAL_PARAMS)
+    return path + "?" + urllib.urlencode(params)
+
+
+def generate_board(board_id="b" * 24, actions_count=1000, lists=None, seed=0,
+                   start=datetime.datetime(2016, 1, 1)):
+    """
+    generate a board with cards moving from left to right through lists
+
+    :return: dict, {"id", "name", "lists", "cards", "actions"}; actions are oldest first
+    """
+    rnd = random.Random(seed)
+    lists = [{"id": object_id(start, i + 1), "name": name}
+             for i, name in enumerate(lists or DEFAULT_LISTS)]
+    board = {"id": board_id, "name": "Board %s" % board_id}
+    cards = {}
+    actions = []
+    date = start
+
+    def action(action_type, card, **data):
+        data["board"] = {"id": board_id, "name": board["name"]}
+        data["card"] = {
+            "id": card["id"],
+            "name": card["name"],
+            "idShort": card["idShort"],
+            "shortLink": card["shortLink"],
+        }
+        actions.append({
+            "id": object_id(date, len(actions) + 0x100000),
+            "date": format_date(date),
+            "type": action_type,
+            "data": data,
+        })
+
+    while len(actions) < actions_count:
+        date += datetime.timedelta(seconds=rnd.randint(1, 7200),
+                                   microseconds=rnd.randint(0, 999) * 1000)
+        open_cards = [c for c in cards.values() if not c["closed"]]
+        if not open_cards or rnd.random() < 0.25:
+            short_id = len(cards) + 1
+            card = {
+                "id": object_id(date, short_id + 0x200000),
+                "idShort": short_id,
+                "shortLink": "c%07d" % short_id,
+                "name": "(%d) Card %d" % (rnd.choice([1, 2, 3, 5, 8]), short_id),
+                "idList": lists[0]["id"],
+                "closed": False,
+                "due": None,
+            }
+            cards[card["id"]] = card
+            action("createCard", card, list=lists[0])
+        else:
+            card = rnd.choice(open_cards)
+            list_index = [li["id"] for li in lists].index(card["idList"])
+            roll = rnd.random()
+            if roll < 0.15:
+                old_name = card["name"]
+                card["name"] = "(%d) Card %d" % (rnd.choice([1, 2, 3, 5, 8]), card["idShort"])
+                action("updateCard", card, list=lists[list_index], old={"name": old_name})
+            elif roll < 0.25 or list_index == len(lists) - 1:
+                card["closed"] = True
+                action("updateCard", card, list=lists[list_index], old={"closed": False})
+            else:
+                target = lists[list_index + 1]
+                action("updateCard", card, listBefore=lists[list_index], listAfter=target,
+                       old={"idList": card["idList"]})
+                card["idList"] = target["id"]
+        card["dateLastActivity"] = format_date(date)
+        card["idBoard"] = board_id
+
+    board["lists"] = lists
+    board["cards"] = sorted(cards.values(), key=lambda x: x["idShort"])
+    board["actions"] = actions
+    return board
+
+
+class StandInData(object):
+    """ boards served by the stand-in """
+
+    def __init__(self, boards=None, member=None):
+        self.member = member or {"id": "m" * 24, "username": "standin",
+                                 "fullName": "Stand In"}
+        self.boards = {}
+        self.cards = {}
+        for board in boards or []:
+            self.add_board(board)
+
+    def add_board(self, board):
+        """ :param board: dict, see generate_board """
+        for a in board["actions"]:
+            a.setdefault("_date", parse_datetime(a["date"]))
+        # newest first, that's how trello returns them
+        board["actions"].sort(key=lambda x: x["_date"], reverse=True)
+        self.boards[board["id"]] = board
+        for card in board["cards"]:
+            self.cards[card["id"]] = card
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as fd:
+            j = json.load(fd)
+        return cls(boards=j["boards"], member=j.get("member", None))
+
+    def dump(self, path):
+        boards = []
+        for board in self.boards.values():
+            board = dict(board)
+            board["actions"] = [{k: v for k, v in a.items() if k != "_date"}
+                                for a in board["actions"]]
+            boards.append(board)
+        with open(path, "w") as fd:
+            json.dump({"boards": boards, "member": self.member}, fd)
+
+    @staticmethod
+    def fields(obj, params):
+        fields = params.get("fields", None)
+        if not fields or fields == "all":
+            return obj
+        response = {k: obj.get(k, None) for k in fields.split(",")}
+        response["id"] = obj["id"]
+        return response
+
+    @staticmethod
+    def action_matches(action, filters):
+        if not filters:
+            return True
+        if action["type"] in filters:
+            return True
+        return any("%s:%s" % (action["type"], k) in filters
+                   for k in action["data"].get("old", {}))
+
+    def board_actions(self, board, params):
+        filters = set(params["filter"].split(",")) if "filter" in params else None
+        limit = int(params.get("limit", 50))
+        before = date_param(params, "before")
+        since = date_param(params, "since")
+        response = []
+        for a in board["actions"]:
+            if before and a["_date"] >= before:
+                continue
+            if since and a["_date"] < since:
+                # since is inclusive
+                break
+            if not self.action_matches(a, filters):
+                continue
+            response.append({k: v for k, v in a.items() if k != "_date"})
+            if len(response) >= limit:
+                break
+        return response
+
+    def board_cards(self, board, params):
+        cards = board["cards"]
+        before = date_param(params, "before")
+        if before is not None:
+            # "before" filters by creation date, which is part of the id
+            before = calendar.timegm(before.utctimetuple())
+            cards = [c for c in cards if object_timestamp(c["id"]) < before]
+        if params.get("filter", "visible") != "all":
+            cards = [c for c in cards if not c.get("closed", False)]
+        return [self.fields(c, params) for c in cards]
+
+    def resolve(self, path, params):
+        """
+        :param path: str, without API version, e.g. "/boards/<id>/actions"
+        :param params: dict
+        :return: tuple, (status code, json-like structure)
+        """
+        parts = [x for x in path.split("/") if x]
+        try:
+            if parts[0] == "boards" and parts[2] == "actions":
+                return 200, self.board_actions(self.boards[parts[1]], params)
+            if parts[0] == "boards" and parts[2] == "cards":
+                return 200, self.board_cards(self.boards[parts[1]], params)
+            if parts[:3] == ["members", "me", "boards"]:
+                return 200, [self.fields(b, params) for b in self.boards.values()]
+            if parts[0] == "cards":
+                return 200, self.fields(self.cards[parts[1]], params)
+            if parts[0] == "tokens" and parts[2:] == ["member"]:
+                return 200, self.member
+            if parts[0] == "tokens":
+                return 200, {"id": parts[1], "idMember": self.member["id"]}
+        except (IndexError, KeyError):
+            pass
+        except ValueError as ex:
+            return 400, str(ex)
+        return 404, "The requested resource was not found."
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # keep-alive
+    protocol_version = "HTTP/1.1"
+    # set by TrelloStandIn
+    standin = None
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def respond(self, status, body, headers=None):
+        if not isinstance(body, basestring):
+            body = json.dumps(body)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        standin = self.standin
+        standin.count("requests")
+        if standin.latency:
+            time.sleep(standin.latency)
+        if standin.throttle_rate and standin.random.random() < standin.throttle_rate:
+            standin.count("throttled")
+            return self.respond(429, {"message": "API_TOKEN_LIMIT_EXCEEDED"},
+                                headers={"Retry-After": str(standin.retry_after)})
+        path, query = urlparse.urlsplit(self.path)[2:4]
+        prefix = "/" + standin.api_version
+        if path.startswith(prefix + "/"):
+            path = path[len(prefix):]
+        status, body = standin.handle(path, query)
+        self.respond(status, body)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class TrelloStandIn(object):
+    """
+    HTTP server mimicking trello API
+
+    modes:
+     * data is set: serve StandInData
+     * cassette is set: replay recorded responses
+     * upstream is set: forward requests to real trello and record them into cassette
+    """
+
+    def __init__(self, data=None, cassette=None, upstream=None, host="127.0.0.1", port=0,
+                 latency=0.0, throttle_rate=0.0, retry_after=0, seed=0, api_version="1"):
+        self.data = data
+        self.cassette = cassette if cassette is not None else {}
+        self.upstream = upstream
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.api_version = api_version
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "throttled": 0}
+
+        class Handler(StandInHandler):
+            standin = self
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%s" % (host, port)
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def handle(self, path, query):
+        """ :return: tuple, (status code, body) """
+        if self.upstream:
+            return self.record(path, query)
+        if self.data is None:
+            key = request_key(path, query)
+            try:
+                return tuple(self.cassette[key])
+            except KeyError:
+                logger.warning("request %s was not recorded", key)
+                return 404, "The requested resource was not found."
+        params = dict(urlparse.parse_qsl(query))
+        if path == "/batch":
+            response = []
+            for route in params.get("urls", "").split(","):
+                route_path, route_query = urlparse.urlsplit(route)[2:4]
+                status, body = self.handle(route_path, route_query)
+                if status == 200:
+                    response.append({"200": body})
+                else:
+                    response.append({"name": "NotFound", "message": body, "statusCode": status})
+            return 200, response
+        return self.data.resolve(path, params)
+
+    def record(self, path, query):
+        url = "%s/%s%s?%s" % (self.upstream, self.api_version, path, query)
+        response = requests.get(url)
+        body = response.content
+        with self.lock:
+            self.cassette[request_key(path, query)] = (response.status_code, body)
+        return response.status_code, body
+
+    def save_cassette(self, path):
+        with self.lock:
+            with open(path, "w") as fd:
+                json.dump(self.cassette, fd)
+
+    @staticmethod
+    def load_cassette(path):
+        with open(path) as fd:
+            return json.load(fd)
+
+    def start(self):
+        """ serve in a background thread """
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds to wait before responding")
+    parser.add_argument("--throttle-rate", type=float, default=0.0,
+                        help="fraction of requests answered with 429")
+    parser.add_argument("--retry-after", type=int, default=0)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--synthetic", type=int, metavar="ACTIONS",
+                        help="serve a generated board with this many actions")
+    source.add_argument("--boards", metavar="PATH", help="serve boards from a JSON file")
+    source.add_argument("--replay", metavar="PATH", help="replay recorded session")
+    source.add_argument("--record", metavar="PATH",
+                        help="proxy to real trello and record the session")
+    parser.add_argument("--upstream", default="https://api.trello.com")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    kwargs = {"host": args.host, "port": args.port, "latency": args.latency,
+              "throttle_rate": args.throttle_rate, "retry_after": args.retry_after}
+    if args.synthetic:
+        kwargs["data"] = StandInData(boards=[generate_board(actions_count=args.synthetic)])
+    elif args.boards:
+        kwargs["data"] = StandInData.load(args.boards)
+    elif args.replay:
+        kwargs["cassette"] = TrelloStandIn.load_cassette(args.replay)
+    else:
+        kwargs["upstream"] = args.upstream
+
+    standin = TrelloStandIn(**kwargs)
+    logger.info("serving trello stand-in at %s", standin.url)
+    if args.synthetic:
+        logger.info("board id: %s", standin.data.boards.keys()[0])
+    try:
+        standin.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.record:
+            standin.save_cassette(args.record)
+            logger.info("session recorded into %s", args.record)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,14 +8,17 @@ https://api.trello.com/1/cards/4eea503d91e31d174600008f?fields=name,idList&membe
 
 """
 
+import json
 import urllib
 import logging
+import tempfile
 import urlparse
-
-import requests
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
 
+from trello_reporter.harvesting import throttling, transport
+
 
 logger = logging.getLogger(__name__)
 
@@ -23,17 +26,82 @@ logger = logging.getLogger(__name__)
 TRELLO_API_SCHEME = "https"
 TRELLO_API_NETLOC = "api.trello.com"
 API_VERSION = "1"
+# maximum number of routes trello resolves in a single /batch request
+BATCH_MAX_URLS = 10
+
+
+class ActionSpool(object):
+    """
+    actions stored in a temporary NDJSON file, so they don't need to be held in memory
+
+    pages are written as they come from trello (newest first) and replayed oldest first; only a
+    single page is loaded in memory while iterating
+    """
+
+    def __init__(self):
+        self.f = tempfile.TemporaryFile()
+        # (offset, number of actions) of every page, in order of writing
+        self.pages = []
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """ oldest first """
+        for offset, size in reversed(self.pages):
+            self.f.seek(offset)
+            page = [self.f.readline() for _ in range(size)]
+            for line in reversed(page):
+                yield json.loads(line)
+
+    def write_page(self, actions):
+        """
+        :param actions: list of json-like structures, newest first
+        """
+        self.f.seek(0, 2)
+        self.pages.append((self.f.tell(), len(actions)))
+        for action in actions:
+            self.f.write(json.dumps(action) + "\n")
+        self.count += len(actions)
+
+    @property
+    def oldest(self):
+        """ the oldest action or None if there are no actions """
+        for action in self:
+            return action
+
+    def close(self):
+        self.f.close()
 
 
 class Harvestor(object):
 
-    def __init__(self, token, api_key=None):
+    def __init__(self, token, api_key=None, scheduler=None, api_url=None, session=None):
+        """
+        creating a Harvestor is cheap, connections are pooled per process, see transport
+
+        :param session: requests.Session-like object, defaults to transport.pool
+        """
         if api_key is None:
             api_key = settings.API_KEY
+        if scheduler is None:
+            scheduler = throttling.scheduler
+        if api_url is None:
+            api_url = settings.TRELLO_API_URL
         self.token = token
         self.api_key = api_key
+        # e.g. a local stand-in of trello API, see fake_trello
+        self.scheme, self.netloc = urlparse.urlsplit(api_url)[:2]
         self.params = {"token": token, "key": api_key}
-        self.s = requests.Session()
+        self.s = session or transport.pool
+        self.scheduler = scheduler
 
     def url(self, endpoint, params=None):
         """
@@ -43,31 +111,49 @@ class Harvestor(object):
         :param params: dict
         :return: str
         """
-        params = params or {}
+        # unset parameters are not sent, urlencode would turn them into "None"
+        params = {k: v for k, v in (params or {}).items() if v is not None}
         params.update(self.params)
         encoded_params = urllib.urlencode(params)
         url = urlparse.urlunsplit(
-            (TRELLO_API_SCHEME, TRELLO_API_NETLOC, API_VERSION + "/" + endpoint, encoded_params, "")
+            (self.scheme, self.netloc, API_VERSION + "/" + endpoint, encoded_params, "")
         )
         return url
 
+    @staticmethod
+    def route(endpoint, params=None):
+        """
+        construct route for /batch: path and query without API version and credentials
+
+        :param endpoint: str
+        :param params: dict
+        :return: str
+        """
+        route = "/" + endpoint
+        if params:
+            route += "?" + urllib.urlencode(params)
+        return route
+
     def get_json(self, url):
-        response = self.s.get(url)
+        response = self.scheduler.get(self.s, url, self.api_key, self.token)
         if response.status_code == 401:
             logger.warning("can't access resource: %s", response.content)
             return
+        if response.status_code == 429 or response.status_code >= 500:
+            # the scheduler gave up retrying
+            response.raise_for_status()
         return response.json()
 
-    def get_card_actions(self, board_id, since=None):
+    def iter_card_actions(self, board_id, since=None):
         """
-        fetch card actions relevant to movement and name changes of cards on a specific board
+        fetch card actions relevant to movement and name changes of cards on a specific board,
+        page by page as they arrive
 
         :param board_id: str
         :param since: datetime or None
-        :return: list of json-like structures
+        :return: generator of lists of json-like structures, newest first
         """
         logger.info("fetch card actions for board %s, since=%s", board_id, since)
-        response = []
         before = None
         filters = [
             "createCard",
@@ -98,10 +184,39 @@ class Harvestor(object):
                 # trello returns [] if there are no actions
                 break
             before = j[-1]["date"]
-            response += j
+            yield j
+
+    def get_card_actions(self, board_id, since=None):
+        """
+        fetch all card actions of a board at once, see iter_card_actions
+
+        :param board_id: str
+        :param since: datetime or None
+        :return: list of json-like structures, oldest first
+        """
+        response = []
+        for page in self.iter_card_actions(board_id, since=since):
+            response += page
         response.reverse()  # oldest first
         return response
 
+    def spool_card_actions(self, board_id, since=None):
+        """
+        fetch card actions of a board into a temporary file, see iter_card_actions
+
+        :param board_id: str
+        :param since: datetime or None
+        :return: ActionSpool
+        """
+        spool = ActionSpool()
+        try:
+            for page in self.iter_card_actions(board_id, since=since):
+                spool.write_page(page)
+        except Exception:
+            spool.close()
+            raise
+        return spool
+
     def get_cards_on_board(self, board_id, before=None):
         fields = "id,name,idBoard,idList,dateLastActivity"
         params = {
@@ -116,6 +231,31 @@ class Harvestor(object):
         url = self.url('members/me/boards', params={"fields": "name"})
         return self.get_json(url)
 
+    def get_batch(self, requests_list):
+        """
+        resolve multiple GET requests using /batch, up to BATCH_MAX_URLS per round trip
+
+        :param requests_list: list of tuples, (endpoint, params)
+        :return: list, response of every request in the same order, None if it failed
+        """
+        response = []
+        routes = [self.route(endpoint, params) for endpoint, params in requests_list]
+        for i in range(0, len(routes), BATCH_MAX_URLS):
+            chunk = routes[i:i + BATCH_MAX_URLS]
+            url = self.url("batch", params={"urls": ",".join(chunk)})
+            j = self.get_json(url)
+            if not j:
+                response += [None] * len(chunk)
+                continue
+            for route, item in zip(chunk, j):
+                # {"200": <response>} or {"name": ..., "message": ..., "statusCode": ...}
+                try:
+                    response.append(item["200"])
+                except (KeyError, TypeError):
+                    logger.warning("can't access resource %s: %s", route, item)
+                    response.append(None)
+        return response
+
     def get_due_of_cards(self, trello_card_ids):
         """
 
@@ -123,14 +263,36 @@ class Harvestor(object):
         :return:
         """
         response = {}
+        trello_card_ids = list(trello_card_ids)
         params = {"fields": "due"}
-        for card_id in trello_card_ids:
-            url = self.url("cards/" + card_id, params=params)
-            j = self.get_json(url)
+        requests_list = [("cards/" + card_id, params) for card_id in trello_card_ids]
+        for card_id, j in zip(trello_card_ids, self.get_batch(requests_list)):
             if j:
                 response[card_id] = j["due"]
         return response
 
+    def get_due_of_cards_on_board(self, board_id, trello_card_ids):
+        """
+        due dates of cards: a single request lists the whole board; cards which are not on the
+        board anymore (e.g. moved to a different one) are fetched one by one
+
+        :param board_id: str
+        :param trello_card_ids: list of str
+        :return: dict, trello card id -> due
+        """
+        wanted = set(trello_card_ids)
+        if not wanted:
+            return {}
+        params = {"filter": "all", "fields": "due"}
+        url = self.url("boards/%s/cards" % board_id, params=params)
+        j = self.get_json(url) or []
+        response = {c["id"]: c["due"] for c in j if c["id"] in wanted}
+        missing = wanted.difference(response)
+        if missing:
+            logger.info("%d cards are not on board %s", len(missing), board_id)
+            response.update(self.get_due_of_cards(missing))
+        return response
+
     def get_token_info(self, token):
         url = self.url("tokens/" + token)
         return self.get_json(url)
@@ -138,3 +300,59 @@ class Harvestor(object):
     def get_member_info_by_token(self, token):
         url = self.url("tokens/" + token + "/member")
         return self.get_json(url)
+
+
+class ConcurrentHarvestor(object):
+    """
+    Harvestor for many boards at once: methods accept a list of boards (or cards) and requests
+    are sent concurrently from a pool of threads; results are returned in the order of input
+    """
+
+    def __init__(self, token, api_key=None, concurrency=None):
+        if concurrency is None:
+            concurrency = settings.HARVEST_CONCURRENCY
+        self.token = token
+        self.api_key = api_key
+        self.concurrency = concurrency
+        # connections are shared by threads, see transport
+        self.harvestor = Harvestor(token, api_key=api_key)
+
+    def map(self, fn, items):
+        """
+        call fn(harvestor, item) for every item, at most self.concurrency at once
+
+        :param fn: callable
+        :param items: list
+        :return: list of results
+        """
+        if not items:
+            return []
+        pool = ThreadPool(min(self.concurrency, len(items)))
+        try:
+            return pool.map(lambda item: fn(self.harvestor, item), items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_card_actions(self, board_ids, since=None):
+        return self.map(lambda h, board_id: h.get_card_actions(board_id, since=since), board_ids)
+
+    def spool_card_actions(self, board_ids, since=None):
+        return self.map(lambda h, board_id: h.spool_card_actions(board_id, since=since),
+                        board_ids)
+
+    def get_cards_on_board(self, board_ids, before=None):
+        return self.map(lambda h, board_id: h.get_cards_on_board(board_id, before=before),
+                        board_ids)
+
+    def list_boards(self):
+        return self.harvestor.list_boards()
+
+    def get_due_of_cards(self, trello_card_ids):
+        trello_card_ids = list(trello_card_ids)
+        chunks = [trello_card_ids[i:i + BATCH_MAX_URLS]
+                  for i in range(0, len(trello_card_ids), BATCH_MAX_URLS)]
+        response = {}
+        for due_dict in self.map(lambda h, chunk: h.get_due_of_cards(chunk), chunks):
+            response.update(due_dict)
+        return response
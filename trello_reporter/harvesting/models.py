@@ -1,23 +1,77 @@
 from __future__ import unicode_literals
 
-import copy
-
 from django.db import models
 from django.contrib.postgres.fields import JSONField
+from django.utils.functional import cached_property
 
 
 def graceful_chain_get(d, *args):
     if not d:
         return None
-    t = copy.deepcopy(d)
+    t = d
     for arg in args:
         try:
             t = t[arg]
-        except (IndexError, KeyError):
+        except (IndexError, KeyError, TypeError):
             return None
     return t
 
 
+class EventView(object):
+    """
+    fields of an action sent by trello which we care about, picked up from the json once
+
+    there are lots of events to go through, hence __slots__
+    """
+    __slots__ = (
+        "card_id", "card_name", "card_short_id", "card_closed",
+        "list_id", "list_name",
+        "list_before_id", "list_before_name",
+        "list_after_id", "list_after_name",
+        "has_list_before", "old_name_set", "old_closed",
+    )
+
+    def __init__(self, data):
+        """
+        :param data: json-like structure, action as returned by trello
+        """
+        d = (data or {}).get("data", None) or {}
+        card = d.get("card", None) or {}
+        self.card_id = card.get("id", None)
+        self.card_name = card.get("name", None)
+        self.card_short_id = card.get("idShort", None)
+        self.card_closed = card.get("closed", False)
+        li = d.get("list", None) or {}
+        self.list_id = li.get("id", None)
+        self.list_name = li.get("name", None)
+        self.has_list_before = "listBefore" in d
+        li = d.get("listBefore", None) or {}
+        self.list_before_id = li.get("id", None)
+        self.list_before_name = li.get("name", None)
+        li = d.get("listAfter", None) or {}
+        self.list_after_id = li.get("id", None)
+        self.list_after_name = li.get("name", None)
+        old = d.get("old", None) or {}
+        self.old_name_set = "name" in old
+        # None = the action didn't change the state
+        self.old_closed = old.get("closed", None)
+
+    @property
+    def rename(self):
+        return self.old_name_set
+
+    @property
+    def opening(self):
+        """ does this action opens (sends to board) the card? """
+        return bool(self.old_closed)
+
+    @property
+    def archiving(self):
+        """ does this action closes (archives) the card? """
+        was_closed = True if self.old_closed is None else self.old_closed
+        return self.card_closed or not was_closed
+
+
 class CardActionEventQuerySet(models.QuerySet):
     def for_card(self, trello_card_id):
         return self.filter(data__data__card__id=trello_card_id)
@@ -62,28 +116,35 @@ class CardActionEvent(models.Model):
     #                      u'username': u'tomastomecek1'},
     #   u'type': u'updateCard'},
     data = JSONField()
+    # id of the action in trello, None for synthetic actions; actions are stored only once
+    trello_id = models.CharField(max_length=32, unique=True, blank=True, null=True)
     processed_well = models.BooleanField(default=False)  # = is there an equal CardAction?
 
     objects = CardActionEventManager.from_queryset(CardActionEventQuerySet)()
 
+    @cached_property
+    def view(self):
+        """ EventView of data """
+        return EventView(self.data)
+
     @property
     def card_name(self):
-        return graceful_chain_get(self.data, "data", "card", "name")
+        return self.view.card_name
 
     @property
     def card_id(self):
-        return graceful_chain_get(self.data, "data", "card", "id")
+        return self.view.card_id
 
     @property
     def list_name(self):
-        return graceful_chain_get(self.data, "data", "list", "name")
+        return self.view.list_name
 
     @property
     def card_short_id(self):
-        return graceful_chain_get(self.data, "data", "card", "idShort")
+        return self.view.card_short_id
 
     @property
     def card_url(self):
-        u = graceful_chain_get(self.data, "data", "card", "id")
+        u = self.view.card_id
         if u:
             return "https://trello.com/c/%s" % u
@@ -1,6 +1,14 @@
 import urlparse
 
-from .harvestor import Harvestor, API_VERSION, TRELLO_API_NETLOC, TRELLO_API_SCHEME
+import requests
+from flexmock import flexmock
+
+from .harvestor import Harvestor, ActionSpool, ConcurrentHarvestor, API_VERSION, \
+    TRELLO_API_NETLOC, TRELLO_API_SCHEME
+from .throttling import TokenBucket, RequestScheduler
+from .transport import ConnectionPool
+from .models import EventView
+from .fake_trello import TrelloStandIn, StandInData, generate_board
 
 
 def test_url_composing():
@@ -14,3 +22,231 @@ def test_url_composing():
     assert split[1] == TRELLO_API_NETLOC
     assert split[2] == "/" + API_VERSION + "/" + endpoint
     assert urlparse.parse_qs(split[3]) == {"token": [token], "key": [api_key]}
+
+    url = h.url(endpoint, params={"before": None, "filter": "all"})
+    assert urlparse.parse_qs(urlparse.urlsplit(url)[3]) == \
+        {"token": [token], "key": [api_key], "filter": ["all"]}
+
+
+def test_action_spool_replays_oldest_first():
+    with ActionSpool() as spool:
+        spool.write_page([{"date": "5"}, {"date": "4"}, {"date": "3"}])
+        spool.write_page([{"date": "2"}, {"date": "1"}])
+        assert len(spool) == 5
+        assert spool.oldest == {"date": "1"}
+        assert [x["date"] for x in spool] == ["1", "2", "3", "4", "5"]
+        # can be replayed multiple times
+        assert [x["date"] for x in spool] == ["1", "2", "3", "4", "5"]
+
+
+def test_card_actions_pagination():
+    pages = [[{"date": "4"}, {"date": "3"}], [{"date": "2"}, {"date": "1"}], []]
+    h = Harvestor("123", api_key="456")
+    flexmock(h).should_receive("get_json").and_return(*pages).one_by_one()
+    with h.spool_card_actions("b") as spool:
+        assert [x["date"] for x in spool] == ["1", "2", "3", "4"]
+
+
+def test_due_of_cards_on_board():
+    h = Harvestor("123", api_key="456")
+    flexmock(h).should_receive("get_json").and_return([
+        {"id": "a", "due": "2016-01-01T00:00:00.000Z"},
+        {"id": "b", "due": None},
+        {"id": "c", "due": "2016-02-01T00:00:00.000Z"},
+    ]).once()
+    flexmock(h).should_receive("get_due_of_cards").with_args({"d"}).and_return({"d": "x"}).once()
+    assert h.get_due_of_cards_on_board("board", ["a", "b", "d"]) == {
+        "a": "2016-01-01T00:00:00.000Z",
+        "b": None,
+        "d": "x",
+    }
+
+
+def test_batch_splits_requests():
+    h = Harvestor("123", api_key="456")
+    requested = []
+
+    def get_json(url):
+        routes = urlparse.parse_qs(urlparse.urlsplit(url)[3])["urls"][0].split(",")
+        requested.append(routes)
+        return [{"200": {"route": r}} if not r.endswith("3") else
+                {"name": "NotFound", "message": "not found", "statusCode": 404}
+                for r in routes]
+
+    flexmock(h).should_receive("get_json").replace_with(get_json)
+    response = h.get_batch([("cards/%d" % i, None) for i in range(13)])
+    assert [len(x) for x in requested] == [10, 3]
+    assert len(response) == 13
+    assert response[0] == {"route": "/cards/0"}
+    assert response[3] is None
+    assert response[12] == {"route": "/cards/12"}
+
+
+def test_concurrent_harvestor_keeps_order():
+    flexmock(Harvestor).should_receive("get_cards_on_board").replace_with(
+        lambda board_id, before=None: [board_id])
+    h = ConcurrentHarvestor("123", api_key="456", concurrency=3)
+    board_ids = [str(x) for x in range(10)]
+    assert h.get_cards_on_board(board_ids) == [[x] for x in board_ids]
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_token_bucket_waits_when_empty():
+    clock = FakeClock()
+    bucket = TokenBucket(2, 10.0, clock=clock.time, sleep=clock.sleep)
+    assert bucket.acquire() == 0
+    assert bucket.acquire() == 0
+    # one token per 5 seconds
+    assert bucket.acquire() == 5.0
+    assert clock.now == 5.0
+
+
+def test_scheduler_retries_throttled_requests():
+    clock = FakeClock()
+    scheduler = RequestScheduler(clock=clock.time, sleep=clock.sleep)
+    throttled = flexmock(status_code=429, headers={"Retry-After": "3"})
+    ok = flexmock(status_code=200, headers={})
+    session = flexmock()
+    session.should_receive("get").and_return(throttled).and_return(ok).one_by_one()
+
+    assert scheduler.get(session, "url", "key", "token") is ok
+    assert clock.slept == [3.0]
+    stats = scheduler.get_stats()
+    assert stats["requests"] == 2
+    assert stats["throttled"] == 1
+    assert stats["retried"] == 1
+    assert stats["failed"] == 0
+
+
+def test_scheduler_gives_up():
+    clock = FakeClock()
+    scheduler = RequestScheduler(max_retries=2, clock=clock.time, sleep=clock.sleep)
+    error = flexmock(status_code=503, headers={})
+    session = flexmock()
+    session.should_receive("get").and_return(error)
+
+    assert scheduler.get(session, "url", "key", "token") is error
+    assert len(clock.slept) == 2
+    assert scheduler.get_stats()["failed"] == 1
+
+
+def test_scheduler_retries_stalled_requests():
+    clock = FakeClock()
+    scheduler = RequestScheduler(timeout=(1.0, 5.0), clock=clock.time, sleep=clock.sleep)
+    ok = flexmock(status_code=200, headers={})
+    timeouts = []
+
+    def get(url, timeout=None):
+        timeouts.append(timeout)
+        if len(timeouts) == 1:
+            raise requests.Timeout("read timed out")
+        return ok
+
+    session = flexmock(get=get)
+    assert scheduler.get(session, "url", "key", "token") is ok
+    assert timeouts == [(1.0, 5.0)] * 2
+    assert scheduler.get_stats()["retried"] == 1
+
+
+def test_card_actions_pagination_against_standin():
+    board = generate_board(actions_count=2500)
+    with TrelloStandIn(data=StandInData(boards=[board])) as standin:
+        h = Harvestor("123", api_key="456", api_url=standin.url)
+        pages = list(h.iter_card_actions(board["id"]))
+        actions = h.get_card_actions(board["id"])
+    assert [len(x) for x in pages] == [1000, 1000, 500]
+    assert [x["id"] for x in actions] == [x["id"] for x in reversed(board["actions"])]
+
+
+def test_standin_rejects_invalid_dates():
+    board = generate_board(actions_count=10)
+    data = StandInData(boards=[board])
+    path = "/boards/%s/cards" % board["id"]
+    assert data.resolve(path, {"before": "None"}) == (400, "invalid value for before")
+    assert data.resolve(path, {"before": board["actions"][-1]["date"]})[0] == 200
+
+
+def test_standin_throttling_is_retried():
+    board = generate_board(actions_count=300)
+    clock = FakeClock()
+    scheduler = RequestScheduler(max_retries=20, clock=clock.time, sleep=clock.sleep)
+    data = StandInData(boards=[board])
+    with TrelloStandIn(data=data, throttle_rate=0.5, retry_after=2) as standin:
+        h = Harvestor("123", api_key="456", scheduler=scheduler, api_url=standin.url)
+        cards = h.get_cards_on_board(board["id"])
+        actions = h.get_card_actions(board["id"])
+    assert len(cards) == len(board["cards"])
+    assert len(actions) == 300
+    stats = scheduler.get_stats()
+    assert stats["throttled"] == standin.counters["throttled"] > 0
+    assert clock.slept == [2.0] * stats["throttled"]
+
+
+def test_harvestors_share_connections():
+    board = generate_board(actions_count=10)
+    pool = ConnectionPool(pool_size=2)
+    with TrelloStandIn(data=StandInData(boards=[board])) as standin:
+        for token in ("123", "456", "789"):
+            h = Harvestor(token, api_key="456", api_url=standin.url, session=pool)
+            h.get_cards_on_board(board["id"])
+    stats = pool.get_stats()
+    assert stats["requests"] == 3
+    assert stats["connections"] == 1
+    assert stats["reused"] == 2
+
+
+def test_connection_pool_is_shared_by_threads():
+    boards = [generate_board(board_id=x * 24, actions_count=10) for x in "abcdef"]
+    pool = ConnectionPool(pool_size=2)
+    sessions = set()
+
+    def get_cards(h, board_id):
+        sessions.add(id(pool.session))
+        return h.get_cards_on_board(board_id)
+
+    with TrelloStandIn(data=StandInData(boards=boards)) as standin:
+        h = ConcurrentHarvestor("123", api_key="456", concurrency=3)
+        h.harvestor = Harvestor("123", api_key="456", api_url=standin.url, session=pool)
+        for _ in range(3):
+            h.map(lambda harvestor, board: get_cards(harvestor, board["id"]), boards)
+        # connections of other hosts are dropped with their pools
+        pool.adapter.poolmanager.clear()
+        h.harvestor.get_cards_on_board(boards[0]["id"])
+    stats = pool.get_stats()
+    assert len(sessions) > 1
+    assert stats["requests"] == 19
+    # at least one before clearing and one after it, every request opened at most one
+    assert stats["connections"] >= 2
+    assert stats["reused"] == stats["requests"] - stats["connections"]
+    assert stats["reused"] > 0
+
+
+def test_event_view():
+    view = EventView({
+        "type": "updateCard",
+        "data": {
+            "card": {"id": "c", "name": "(3) card", "idShort": 7, "closed": True},
+            "list": {"id": "l", "name": "Next"},
+            "old": {"closed": False},
+        },
+    })
+    assert view.card_id == "c"
+    assert view.card_short_id == 7
+    assert (view.list_id, view.list_name) == ("l", "Next")
+    assert view.archiving
+    assert not view.opening
+    assert not view.rename
+    assert not view.has_list_before
+    assert view.list_after_id is None
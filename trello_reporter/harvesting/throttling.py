@@ -0,0 +1,179 @@
+"""
+Keep requests sent to trello within its rate limits
+
+https://developers.trello.com/docs/rate-limits
+
+ * 300 requests per 10 seconds for each API key
+ * 100 requests per 10 seconds for each token
+
+Requests which are throttled anyway (429) or fail on trello's side (5xx) are retried.
+"""
+
+import random
+import logging
+import threading
+import time
+
+import requests
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+# (number of requests, interval in seconds)
+API_KEY_LIMIT = (300, 10.0)
+TOKEN_LIMIT = (100, 10.0)
+
+MAX_RETRIES = 5
+# seconds, the first retry waits up to BACKOFF, then it doubles
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+
+class TokenBucket(object):
+    """ thread-safe token bucket: allow `rate` requests per `per` seconds """
+
+    def __init__(self, rate, per, clock=time.time, sleep=time.sleep):
+        self.capacity = float(rate)
+        self.fill_rate = float(rate) / per
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        take a token, wait until there is one available
+
+        :return: float, seconds spent waiting
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.fill_rate
+            self.sleep(wait)
+            waited += wait
+
+
+class RequestScheduler(object):
+    """
+    send GET requests within rate limits of trello, retry the ones which were throttled or
+    failed; one instance should be shared by all Harvestors in the process
+    """
+
+    def __init__(self, api_key_limit=API_KEY_LIMIT, token_limit=TOKEN_LIMIT,
+                 max_retries=MAX_RETRIES, backoff=BACKOFF, max_backoff=MAX_BACKOFF,
+                 timeout=None, clock=time.time, sleep=time.sleep):
+        """
+        :param timeout: tuple, (connect, read) timeout of a request in seconds, defaults to
+                        settings.HARVEST_CONNECT_TIMEOUT and settings.HARVEST_READ_TIMEOUT
+        """
+        self.api_key_limit = api_key_limit
+        self.token_limit = token_limit
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        # (kind, key) -> TokenBucket
+        self.buckets = {}
+        self.counters = {
+            "requests": 0,   # sent to trello, including retries
+            "delayed": 0,    # had to wait for our own limiter
+            "throttled": 0,  # trello responded with 429
+            "retried": 0,
+            "failed": 0,     # gave up after retries
+        }
+
+    def _bucket(self, kind, key, limit):
+        with self.lock:
+            try:
+                return self.buckets[(kind, key)]
+            except KeyError:
+                bucket = TokenBucket(limit[0], limit[1], clock=self.clock, sleep=self.sleep)
+                self.buckets[(kind, key)] = bucket
+                return bucket
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def get_stats(self):
+        """ :return: dict, copy of counters """
+        with self.lock:
+            return dict(self.counters)
+
+    def wait_for_slot(self, api_key, token):
+        waited = self._bucket("key", api_key, self.api_key_limit).acquire()
+        waited += self._bucket("token", token, self.token_limit).acquire()
+        if waited:
+            self._count("delayed")
+            logger.debug("request delayed by %.2f s", waited)
+
+    def retry_delay(self, attempt, response=None):
+        """ respect Retry-After if trello sent it, exponential backoff with jitter otherwise """
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", None)
+            if retry_after:
+                try:
+                    return max(0.0, float(retry_after))
+                except ValueError:
+                    logger.debug("can't parse Retry-After: %s", retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, session, url, api_key, token):
+        """
+        :param session: requests.Session or transport.ConnectionPool
+        :param url: str
+        :param api_key: str
+        :param token: str
+        :return: requests.Response
+        """
+        timeout = self.timeout
+        if timeout is None:
+            timeout = (settings.HARVEST_CONNECT_TIMEOUT, settings.HARVEST_READ_TIMEOUT)
+        attempt = 0
+        while True:
+            self.wait_for_slot(api_key, token)
+            self._count("requests")
+            response = None
+            try:
+                response = session.get(url, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                if attempt >= self.max_retries:
+                    self._count("failed")
+                    raise
+                logger.warning("request failed: %s", ex)
+            else:
+                if response.status_code == 429:
+                    self._count("throttled")
+                elif response.status_code < 500:
+                    return response
+                if attempt >= self.max_retries:
+                    self._count("failed")
+                    logger.error("giving up after %d retries: %s", attempt, response.status_code)
+                    return response
+                logger.info("trello responded with %s, retrying", response.status_code)
+            delay = self.retry_delay(attempt, response)
+            self._count("retried")
+            self.sleep(delay)
+            attempt += 1
+
+
+# shared by all Harvestors in the process so the limits are global
+scheduler = RequestScheduler()
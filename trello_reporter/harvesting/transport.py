@@ -0,0 +1,149 @@
+"""
+HTTP connections to trello shared by the whole process
+
+Harvestors are created all over the place (index page, board refresh, sprints, authentication),
+so they share one keep-alive connection pool instead of opening (and TLS-handshaking) new
+connections every time.
+"""
+
+import os
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+
+# number of connections opened by the current thread, see CountingAdapter
+_opened = threading.local()
+
+
+def opened_connections():
+    return getattr(_opened, "count", 0)
+
+
+class CountingConnectionMixin(object):
+    def connect(self):
+        # urllib3 connects lazily, in the thread which sends the request
+        _opened.count = opened_connections() + 1
+        return super(CountingConnectionMixin, self).connect()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = type(str("CountingHTTPConnection"),
+                         (CountingConnectionMixin, HTTPConnectionPool.ConnectionCls), {})
+
+
+class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = type(str("CountingHTTPSConnection"),
+                         (CountingConnectionMixin, HTTPSConnectionPool.ConnectionCls), {})
+
+
+class CountingAdapter(HTTPAdapter):
+    """ HTTPAdapter which counts connections it opens, see opened_connections """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(CountingAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": CountingHTTPConnectionPool,
+            "https": CountingHTTPSConnectionPool,
+        }
+
+
+class ConnectionPool(object):
+    """
+    pool of keep-alive connections usable from multiple threads
+
+    requests.Session is not thread-safe, so every thread gets its own session; all of them use
+    the same adapter, urllib3's pool of connections is thread-safe
+
+    the adapter is created lazily and again in a forked child process, sockets can't be shared
+    between processes
+    """
+
+    def __init__(self, pool_size=None):
+        """
+        :param pool_size: int, number of connections kept open per host, defaults to
+                          settings.HARVEST_POOL_SIZE
+        """
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self._adapter = None
+        self._pid = None
+        self._local = threading.local()
+        self.counters = {
+            "requests": 0,
+            "errors": 0,       # no response at all
+            "connections": 0,  # opened
+            "reused": 0,       # requests sent over a connection which was open already
+        }
+
+    def _create_adapter(self):
+        pool_size = self.pool_size or settings.HARVEST_POOL_SIZE
+        logger.debug("creating connection pool of size %d", pool_size)
+        return CountingAdapter(pool_connections=4, pool_maxsize=pool_size)
+
+    @property
+    def adapter(self):
+        with self.lock:
+            if self._adapter is None or self._pid != os.getpid():
+                self._adapter = self._create_adapter()
+                self._pid = os.getpid()
+                self.counters = dict.fromkeys(self.counters, 0)
+            return self._adapter
+
+    @property
+    def session(self):
+        """ session of the current thread """
+        adapter = self.adapter
+        session = getattr(self._local, "session", None)
+        if session is None or session.adapters["https://"] is not adapter:
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._local.session = session
+        return session
+
+    def get(self, url, **kwargs):
+        """ the same as requests.get, over pooled connections """
+        session = self.session
+        opened_before = opened_connections()
+        try:
+            response = session.get(url, **kwargs)
+        except requests.RequestException:
+            with self.lock:
+                self.counters["requests"] += 1
+                self.counters["errors"] += 1
+            raise
+        opened = opened_connections() - opened_before
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["connections"] += opened
+            if not opened:
+                self.counters["reused"] += 1
+        return response
+
+    def get_stats(self):
+        """
+        :return: dict, number of requests, of connections which had to be opened for them and
+                 of requests which reused an open connection
+        """
+        with self.lock:
+            return dict(self.counters)
+
+    def close(self):
+        with self.lock:
+            if self._adapter is not None:
+                self._adapter.close()
+            # sessions of threads are replaced once they notice
+            self._adapter = None
+
+
+# shared by all Harvestors in the process
+pool = ConnectionPool()
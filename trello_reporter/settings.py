@@ -160,3 +160,46 @@ except KeyError:
         "https://trello.com/app-key\n"
         "and set it as environment variable 'API_KEY'"
     )
+
+# can point to a local stand-in of trello API: python -m trello_reporter.harvesting.fake_trello
+TRELLO_API_URL = os.getenv("TRELLO_API_URL", "https://api.trello.com")
+
+# number of boards (or requests) fetched from trello at once
+HARVEST_CONCURRENCY = int(os.getenv("HARVEST_CONCURRENCY", "8"))
+
+# number of keep-alive connections to trello kept open by a process
+HARVEST_POOL_SIZE = int(os.getenv("HARVEST_POOL_SIZE", "16"))
+
+# number of seconds to wait for a connection to trello and for its response; stalled requests
+# are retried
+HARVEST_CONNECT_TIMEOUT = float(os.getenv("HARVEST_CONNECT_TIMEOUT", "10"))
+HARVEST_READ_TIMEOUT = float(os.getenv("HARVEST_READ_TIMEOUT", "60"))
+
+# answer charts from history of lists kept in memory of the process, 1 = enabled
+CHART_TIMELINE = bool(int(os.getenv("CHART_TIMELINE", "0")))
+# max number of boards whose history is kept in memory of a process
+CHART_TIMELINE_SIZE = int(os.getenv("CHART_TIMELINE_SIZE", "16"))
+
+# where computed chart data are cached; DjangoCacheBackend uses CACHES["default"]
+CHART_CACHE_BACKEND = os.getenv("CHART_CACHE_BACKEND",
+                                "trello_reporter.charting.cache.LRUBackend")
+# max number of cached charts in a process, 0 disables the cache
+CHART_CACHE_SIZE = int(os.getenv("CHART_CACHE_SIZE", "256"))
+
+# number of seconds board and user settings are cached by a process (changes made by the
+# process itself are visible right away)
+KEYVAL_CACHE_TTL = int(os.getenv("KEYVAL_CACHE_TTL", "60"))
+
+# number of seconds boards listed for a user are fresh, older listing is refreshed in
+# background
+BOARD_LIST_TTL = int(os.getenv("BOARD_LIST_TTL", "300"))
+
+# number of threads of a process which sync boards in background
+SYNC_WORKERS = int(os.getenv("SYNC_WORKERS", "2"))
+# number of seconds a worker waits for a job before it checks the queue again
+SYNC_POLL_INTERVAL = int(os.getenv("SYNC_POLL_INTERVAL", "5"))
+# number of seconds after which a sync job without any progress is considered abandoned, e.g.
+# because the process which queued it was restarted; until then, syncing of its board can't be
+# requested again; progress is reported only while actions are loaded, so it has to be longer
+# than fetching of the biggest board takes
+SYNC_JOB_TIMEOUT = int(os.getenv("SYNC_JOB_TIMEOUT", "1800"))